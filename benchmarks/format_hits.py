@@ -0,0 +1,133 @@
+"""
+Compare the hit formatting of search results before and after the per query
+formatter.
+
+    python benchmarks/format_hits.py
+"""
+from guillotina_elasticsearch import utils
+from guillotina_elasticsearch.utility import ElasticSearchUtility
+from unittest import mock
+
+import copy
+import timeit
+
+
+FIELDS = [
+    "contributors",
+    "creation_date",
+    "creators",
+    "id",
+    "modification_date",
+    "parent_uuid",
+    "path",
+    "tags",
+    "title",
+    "type_name",
+    "uuid",
+    "metadata.author",
+]
+MULTI_VALUED = {"contributors", "creators", "tags"}
+
+
+def get_result(size=1000):
+    hits = []
+    for idx in range(size):
+        hits.append(
+            {
+                "_id": f"uuid{idx}",
+                "sort": [f"item{idx}", f"uuid{idx}"],
+                "fields": {
+                    "contributors": ["root"],
+                    "creation_date": ["2020-01-01T00:00:00"],
+                    "creators": ["root"],
+                    "id": [f"item{idx}"],
+                    "modification_date": ["2020-01-01T00:00:00"],
+                    "parent_uuid": ["parent"],
+                    "path": [f"/folder/item{idx}"],
+                    "tags": ["one", "two"],
+                    "title": [f"Item {idx}"],
+                    "type_name": ["Item"],
+                    "uuid": [f"uuid{idx}"],
+                    "metadata.author": ["root"],
+                },
+            }
+        )
+    return {"hits": {"hits": hits}}
+
+
+def legacy_format_hit(item):
+    data = item.pop("_source", {})
+    for key, val in item.get("fields", {}).items():
+        container_data = data
+        if isinstance(val, list):
+            if not utils._is_multi_valued(key):
+                if len(val) == 1:
+                    val = val[0]
+                elif len(val) == 0:
+                    val = None
+        if "." in key:
+            name, key = key.split(".", 1)
+            if name not in container_data:
+                container_data[name] = {}
+            container_data = container_data[name]
+        container_data[key] = val
+    return data
+
+
+def legacy_get_items_from_result(container_url, result):
+    items = []
+    for item in result["hits"]["hits"]:
+        data = legacy_format_hit(item)
+        data.update(
+            {
+                "@id": container_url + data.get("path", ""),
+                "@type": data.get("type_name"),
+                "@uid": item["_id"],
+                "@name": data.get("id", data.get("path", "").split("/")[-1]),
+            }
+        )
+        sort_value = item.get("sort")
+        if sort_value:
+            data.update({"sort": sort_value})
+        if "highlight" in item:
+            data["@highlight"] = item["highlight"]
+        items.append(data)
+    return items
+
+
+def main(number=50):
+    utility = ElasticSearchUtility()
+    result = get_result()
+    container_url = "http://localhost:8080/db/container"
+    with mock.patch.object(
+        utils.multi_valued_fields,
+        "_fields",
+        {name: name in MULTI_VALUED for name in FIELDS},
+    ), mock.patch(
+        "guillotina_elasticsearch.utility.get_object_url",
+        lambda container, request: container_url,
+    ):
+        legacy = legacy_get_items_from_result(container_url, copy.deepcopy(result))
+        current = utility._get_items_from_result(None, None, result, FIELDS)
+        assert legacy == current
+
+        # the legacy formatter modifies the hits, copies are made beforehand
+        copies = [copy.deepcopy(result) for _ in range(number)]
+        legacy_time = timeit.timeit(
+            lambda: legacy_get_items_from_result(container_url, copies.pop()),
+            number=number,
+        )
+        current_time = timeit.timeit(
+            lambda: utility._get_items_from_result(None, None, result, FIELDS),
+            number=number,
+        )
+        utils.invalidate_hit_formatters()
+
+    print(f"1000 hits, {number} runs")
+    print(f"legacy:  {legacy_time / number * 1000:.2f} ms per page")
+    print(f"current: {current_time / number * 1000:.2f} ms per page")
+    print(f"speedup: {legacy_time / current_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,12 +17,32 @@ def default_refresh():
 app_settings = {
     "elasticsearch": {
         "bulk_size": 50,
+        "bulk_max_bytes": None,
+        "bulk_concurrency": 4,
+        "defer_migration_writes": False,
+        "deferred_writes_max_pending": 8,
+        "index_name_cache_ttl": 5,
+        "update_coalesce_window": 0,
+        "delete_children_chunk_size": 100,
+        "delete_children_wait_for_completion": True,
+        "track_total_hits": None,
+        "search_cache": {"enabled": False, "size": 1000, "ttl": 5},
+        "indexing_queue": {
+            "enabled": False,
+            "max_size": 10000,
+            "wait": 0.1,
+            "max_attempts": 3,
+        },
         "refresh": "guillotina_elasticsearch.default_refresh",
         "dynamic_mapping": False,
         "index_name_prefix": "guillotina-",
         "connection_settings": {"hosts": [], "timeout": 2},
         "index": {},
         "security_query_builder": "guillotina_elasticsearch.queries.build_security_query",  # noqa
+        "security_query_cache_size": 1000,
+        "security_query_cache_ttl": 5,
+        "parse_cache_size": 1000,
+        "filter_context": True,
     },
     "load_utilities": {
         "catalog": {
@@ -44,6 +64,7 @@ def includeme(root):
     configure.scan("guillotina_elasticsearch.utility")
     configure.scan("guillotina_elasticsearch.manager")
     configure.scan("guillotina_elasticsearch.parser")
+    configure.scan("guillotina_elasticsearch.queries")
 
     # add store true to guillotina indexes
     for name, utility in get_utilities_for(IResourceFactory):
@@ -0,0 +1,268 @@
+from elasticsearch.serializer import JsonSerializer
+from guillotina_elasticsearch.utils import noop_response
+
+import asyncio
+import json
+import logging
+import orjson
+
+
+logger = logging.getLogger("guillotina_elasticsearch")
+
+_default = JsonSerializer().default
+
+
+def dumpb(value):
+    """
+    Serialize value to compact json bytes
+    """
+    try:
+        return orjson.dumps(value, default=_default)
+    except TypeError:
+        # non str keys, big ints... let json module deal with it
+        pass
+    return json.dumps(
+        value, default=_default, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+class BulkOperation:
+    """
+    A bulk action with its source, already encoded as NDJSON lines
+    """
+
+    __slots__ = ("action", "index", "id", "source", "payload")
+
+    def __init__(self, action, index, _id, source, payload):
+        self.action = action
+        self.index = index
+        self.id = _id
+        self.source = source
+        self.payload = payload
+
+    def __len__(self):
+        return len(self.payload)
+
+
+class BulkSerializer:
+    """
+    Builds bulk operations. The action/metadata line prefix is encoded only
+    once per action type and index name.
+    """
+
+    def __init__(self):
+        self._prefixes = {}
+
+    def _get_prefix(self, action, index, retry_on_conflict=None):
+        key = (action, index, retry_on_conflict)
+        try:
+            return self._prefixes[key]
+        except KeyError:
+            pass
+        metadata = {"_index": index}
+        if retry_on_conflict is not None:
+            metadata["retry_on_conflict"] = retry_on_conflict
+        # strip the closing braces so the _id can be appended
+        prefix = dumpb({action: metadata})[:-2] + b',"_id":'
+        self._prefixes[key] = prefix
+        return prefix
+
+    def encode(self, source):
+        return dumpb(source)
+
+    def operation(
+        self, action, index, _id, source=None, encoded=None, retry_on_conflict=None
+    ):
+        """
+        `encoded` can be provided to reuse the already encoded source
+        """
+        payload = self._get_prefix(action, index, retry_on_conflict)
+        payload += dumpb(_id) + b"}}\n"
+        if action != "delete":
+            if encoded is None:
+                encoded = dumpb(source)
+            payload += encoded + b"\n"
+        return BulkOperation(action, index, _id, source, payload)
+
+    def index(self, index, _id, data, encoded=None):
+        return self.operation("index", index, _id, data, encoded)
+
+    def update(self, index, _id, data, encoded=None, retry_on_conflict=3):
+        if encoded is None:
+            encoded = dumpb(data)
+        return self.operation(
+            "update",
+            index,
+            _id,
+            {"doc": data},
+            b'{"doc":' + encoded + b"}",
+            retry_on_conflict=retry_on_conflict,
+        )
+
+    def delete(self, index, _id):
+        return self.operation("delete", index, _id)
+
+    def from_lines(self, bulk_data):
+        """
+        Build operations from a bulk body defined as a list of dicts
+        """
+        operations = []
+        lines = iter(bulk_data)
+        for line in lines:
+            action, metadata = next(iter(line.items()))
+            source = None
+            if action != "delete":
+                source = next(lines)
+            operations.append(
+                self.operation(
+                    action,
+                    metadata.get("_index"),
+                    metadata["_id"],
+                    source,
+                    retry_on_conflict=metadata.get("retry_on_conflict"),
+                )
+            )
+        return operations
+
+
+bulk_serializer = BulkSerializer()
+
+
+def get_bulk_operations(bulk_data):
+    """
+    Bulk data can be a list of operations or a list of dict lines
+    """
+    if len(bulk_data) > 0 and not isinstance(bulk_data[0], BulkOperation):
+        return bulk_serializer.from_lines(bulk_data)
+    return list(bulk_data)
+
+
+def get_bulk_body(operations):
+    return b"".join([operation.payload for operation in operations])
+
+
+def update_to_index_operation(operation):
+    """
+    Convert a partial update operation to a full index of its document
+    """
+    source = operation.source
+    if isinstance(source, dict) and "doc" in source:
+        source = source["doc"]
+    return bulk_serializer.index(operation.index, operation.id, source)
+
+
+class BulkWriter:
+    """
+    Batches bulk operations and pipelines the resulting bulk requests so up
+    to `concurrency` of them are in flight at the same time.
+
+    A batch is flushed once it holds `max_docs` documents or, when
+    `max_bytes` is set, once its serialized size reaches `max_bytes`.
+
+    A document is never split across two bulk requests, so all the actions
+    for a document (one per target index) are always sent together. Results
+    are aggregated in the order the bulk requests were sent.
+    """
+
+    def __init__(
+        self,
+        utility,
+        response=noop_response,
+        concurrency=None,
+        max_docs=None,
+        max_bytes=None,
+        flush_all=False,
+    ):
+        self.utility = utility
+        self.response = response
+        if concurrency is None:
+            concurrency = utility.bulk_concurrency
+        self.concurrency = max(1, int(concurrency))
+        if flush_all:
+            max_docs = max_bytes = None
+        else:
+            if max_docs is None:
+                max_docs = utility.bulk_size
+            if max_bytes is None:
+                max_bytes = utility.bulk_max_bytes
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.batches = []
+        self._operations = []
+        self._idents = []
+        self._size = 0
+        self._futures = []
+        self._in_flight = set()
+
+    async def add(self, ident, operations):
+        """
+        Queue all the bulk operations (one per target index) for a document
+        """
+        size = sum([len(operation) for operation in operations])
+        if self.max_bytes and self._idents and self._size + size > self.max_bytes:
+            await self.flush()
+        self._operations.extend(operations)
+        self._idents.append(ident)
+        self._size += size
+        if (self.max_docs and len(self._idents) >= self.max_docs) or (
+            self.max_bytes and self._size >= self.max_bytes
+        ):
+            await self.flush()
+
+    async def flush(self):
+        if len(self._idents) == 0:
+            return
+        operations, idents, size = self._operations, self._idents, self._size
+        self._operations = []
+        self._idents = []
+        self._size = 0
+        self.batches.append({"docs": len(idents), "bytes": size})
+        logger.debug(f"Sending bulk batch: {len(idents)} docs, {size} bytes")
+        await self.send(operations, idents)
+
+    async def send(self, operations, idents):
+        while len(self._in_flight) >= self.concurrency:
+            _, self._in_flight = await asyncio.wait(
+                self._in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+        future = asyncio.ensure_future(self._send(operations, idents))
+        self._futures.append(future)
+        self._in_flight.add(future)
+
+    async def _send(self, operations, idents):
+        result = await self.utility.bulk_insert(
+            operations, idents, response=self.response
+        )
+        self.utility.log_result(result)
+        return result
+
+    async def close(self):
+        """
+        Flush pending operations, wait for every bulk request to finish and
+        return the aggregated result
+        """
+        await self.flush()
+        futures = self._futures
+        self._futures = []
+        self._in_flight = set()
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        merged = merge_bulk_results(results)
+        merged["batches"] = self.batches
+        return merged
+
+
+def merge_bulk_results(results):
+    merged = {"took": 0, "errors": False, "items": [], "failed": [], "retried": 0}
+    for result in results:
+        result = getattr(result, "body", result)
+        if not result:
+            continue
+        merged["took"] += result.get("took", 0)
+        merged["errors"] = merged["errors"] or bool(result.get("errors"))
+        merged["items"].extend(result.get("items", []))
+        merged["failed"].extend(result.get("failed", []))
+        merged["retried"] += result.get("retried", 0)
+    return merged
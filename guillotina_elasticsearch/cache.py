@@ -0,0 +1,58 @@
+from guillotina_elasticsearch.utils import get_container_cache_key
+from lru import LRU  # pylint: disable=E0611
+
+import copy
+import time
+
+
+class SearchResultCache:
+    """
+    LRU cache of search results that expire after `ttl` seconds.
+
+    Keys are scoped by container, invalidating a container only bumps its
+    generation so its stale results are never returned and get evicted.
+    """
+
+    def __init__(self, size=1000, ttl=5):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._results = LRU(size)
+        self._generations = {}
+
+    def __len__(self):
+        return len(self._results)
+
+    def get_key(self, container, *parts):
+        container_key = get_container_cache_key(container)
+        return (container_key, self._generations.get(container_key, 0)) + parts
+
+    def get(self, key):
+        try:
+            expires, value = self._results[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires < time.monotonic():
+            del self._results[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        # results are mutable, callers get their own copy
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        self._results[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+
+    def invalidate(self, container=None):
+        if container is None:
+            self._results.clear()
+        else:
+            self.invalidate_key(get_container_cache_key(container))
+
+    def invalidate_key(self, container_key):
+        """
+        Invalidate a container from its cache key, for writes sent outside of
+        the task of the container, where the key can not be computed
+        """
+        self._generations[container_key] = self._generations.get(container_key, 0) + 1
@@ -2,6 +2,7 @@ from guillotina.commands import Command
 from guillotina.content import get_all_possible_schemas_for_type
 from guillotina.utils import resolve_dotted_name
 from guillotina_elasticsearch.schema import get_mappings
+from guillotina_elasticsearch.utils import multi_valued_fields
 from pprint import pprint
 
 import operator
@@ -20,6 +21,11 @@ class FieldsCommand(Command):
         parser.add_argument("--summary", action="store_true")
         parser.add_argument("--schema", action="append")
         parser.add_argument("--type", action="append")
+        parser.add_argument(
+            "--multi-valued",
+            action="store_true",
+            help="Report the fields formatted as lists on search results",
+        )
         return parser
 
     def _count_field(self, field, schemas=None):
@@ -70,7 +76,9 @@ class FieldsCommand(Command):
             for type_name in arguments.type:
                 for schema in get_all_possible_schemas_for_type(type_name):
                     self.selected_schemas.append(schema)
-        if self.arguments.summary:
+        if arguments.multi_valued:
+            pprint(multi_valued_fields.as_dict())
+        elif self.arguments.summary:
             self.summary()
         else:
             fields = get_mappings(self.selected_schemas, schema_info=True)["properties"]
@@ -10,6 +10,7 @@ from guillotina_elasticsearch.migration import Migrator
 
 import asyncio
 import logging
+import os
 import time
 
 
@@ -39,6 +40,34 @@ class MigrateCommand(Command):
         parser.add_argument("--memory-tracking", action="store_true")
         parser.add_argument("--reindex-security", action="store_true")
         parser.add_argument("--mapping-only", action="store_true")
+        parser.add_argument(
+            "--workers",
+            help="Number of folders crawled concurrently",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--load-batch-size",
+            help="Number of children loaded from the database at once",
+            type=int,
+            default=100,
+        )
+        parser.add_argument(
+            "--uids-db",
+            help="Sqlite file to keep the document uids on disk instead of "
+            "in memory, {container} is replaced with the container id",
+        )
+        parser.add_argument(
+            "--resume",
+            help="Resume the migration from the checkpoint saved on --uids-db",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--checkpoint-interval",
+            help="Seconds between checkpoints saved on --uids-db",
+            type=int,
+            default=60,
+        )
         return parser
 
     async def migrate_all(self, arguments):
@@ -46,6 +75,14 @@ class MigrateCommand(Command):
         change_transaction_strategy("none")
         await asyncio.sleep(1)  # since something initialize custom types...
         async for _, tm, container in get_containers():
+            uids_db = resume = None
+            if arguments.uids_db:
+                uids_db = arguments.uids_db.format(container=container.id)
+                resume = arguments.resume and os.path.exists(uids_db)
+                if arguments.resume and not resume:
+                    logger.warning(
+                        f"No checkpoint for {container.id}, starting a new migration"
+                    )
             try:
                 self.migrator = Migrator(
                     search,
@@ -58,6 +95,11 @@ class MigrateCommand(Command):
                     reindex_security=arguments.reindex_security,
                     mapping_only=arguments.mapping_only,
                     cache=False,
+                    workers=arguments.workers,
+                    load_batch_size=arguments.load_batch_size,
+                    uids_db=uids_db,
+                    resume=resume,
+                    checkpoint_interval=arguments.checkpoint_interval,
                 )
                 await self.migrator.run_migration()
                 seconds = int(time.time() - self.migrator.start_time)
@@ -72,8 +114,15 @@ Mapping Diff: {self.migrator.mapping_diff}
 """
                 )
             except asyncio.CancelledError:  # pragma: no cover
-                await self.migrator.cancel_migration()
+                if self.migrator.uids_store is not None:
+                    # keep the next index so the migration can be resumed
+                    logger.warning(
+                        "Migration interrupted, run it with --resume to continue"
+                    )
+                else:
+                    await self.migrator.cancel_migration()
             finally:
+                self.migrator.close_uids_store()
                 if self.migrator.status == "done":
                     await tm.commit()
 
@@ -35,6 +35,18 @@ class ReindexCommand(Command):
         parser.add_argument("--memory-tracking", action="store_true")
         parser.add_argument("--reindex-security", action="store_true")
         parser.add_argument("--mapping-only", action="store_true")
+        parser.add_argument(
+            "--workers",
+            help="Number of folders crawled concurrently",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--load-batch-size",
+            help="Number of children loaded from the database at once",
+            type=int,
+            default=100,
+        )
         parser.add_argument("--container", help="Container to index")
         parser.add_argument("--path", help="Path of the container to index")
         return parser
@@ -57,6 +69,8 @@ class ReindexCommand(Command):
                         reindex_security=arguments.reindex_security,
                         mapping_only=arguments.mapping_only,
                         cache=False,
+                        workers=arguments.workers,
+                        load_batch_size=arguments.load_batch_size,
                     )
                     object_to_index = container
                     if arguments.path:
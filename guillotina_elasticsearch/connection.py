@@ -1,5 +1,10 @@
+from elastic_transport import AiohttpHttpNode
 from elasticsearch import AsyncElasticsearch as BaseAsyncElasticsearch
 
+import aiohttp
+import asyncio
+import sys
+
 
 ELASTICSEARCH_COMPATIBILITY_HEADERS = {
     "accept": "application/vnd.elasticsearch+json; compatible-with=8",
@@ -22,8 +27,60 @@ def apply_compatibility_headers(headers=None):
     return headers
 
 
-def get_connection_settings(settings):
+# aiohttp warns about enable_cleanup_closed on python versions that fixed it
+_NEEDS_CLEANUP_CLOSED = (3, 13, 0) <= sys.version_info < (3, 13, 1) or (
+    sys.version_info < (3, 12, 7)
+)
+
+
+class KeepAliveAiohttpHttpNode(AiohttpHttpNode):
+    """
+    aiohttp node with a configurable time to keep idle connections open
+    """
+
+    keepalive_timeout = None
+
+    def _create_aiohttp_session(self):
+        if self.keepalive_timeout is None or not hasattr(self, "_connections_per_node"):
+            # unknown transport version, keep its session
+            return super()._create_aiohttp_session()
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        # same session the transport creates, with the keep alive timeout
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            skip_auto_headers=("accept", "accept-encoding", "user-agent"),
+            auto_decompress=True,
+            loop=self._loop,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            connector=aiohttp.TCPConnector(
+                limit_per_host=self._connections_per_node,
+                use_dns_cache=True,
+                enable_cleanup_closed=_NEEDS_CLEANUP_CLOSED,
+                ssl=self._ssl_context or False,
+                keepalive_timeout=self.keepalive_timeout,
+            ),
+        )
+
+
+def get_keepalive_node_class(keepalive_timeout):
+    return type(
+        "KeepAliveAiohttpHttpNode",
+        (KeepAliveAiohttpHttpNode,),
+        {"keepalive_timeout": keepalive_timeout},
+    )
+
+
+def get_connection_settings(settings, overrides=None):
+    """
+    Client arguments from the connection settings. `overrides` are merged
+    over the settings, used to configure dedicated connections
+    """
     connection_settings = (settings or {}).copy()
+    connection_settings.update(overrides or {})
+    keepalive_timeout = connection_settings.pop("keepalive_timeout", None)
+    if keepalive_timeout is not None and "node_class" not in connection_settings:
+        connection_settings["node_class"] = get_keepalive_node_class(keepalive_timeout)
     if (
         "timeout" in connection_settings
         and "request_timeout" not in connection_settings
@@ -1,3 +1,4 @@
+from guillotina.response import HTTPBadRequest
 from guillotina.response import HTTPError
 
 
@@ -5,6 +6,10 @@ class QueryErrorException(HTTPError):
     status_code = 488
 
 
+class InvalidCursorException(HTTPBadRequest):
+    pass
+
+
 class ElasticsearchConflictException(Exception):
     def __init__(self, conflicts, resp):
         self.conflicts = conflicts
@@ -0,0 +1,207 @@
+from guillotina_elasticsearch.bulk import bulk_serializer
+from guillotina_elasticsearch.utils import get_container_cache_key
+
+import asyncio
+import logging
+
+
+logger = logging.getLogger("guillotina_elasticsearch")
+
+
+def _get_tid(data):
+    return (data or {}).get("tid") or 0
+
+
+def coalesce(current, action, data):
+    """
+    Merge a new write for a document with the one still pending for it.
+    Returns the resulting (action, data).
+
+    Writes can be queued out of order by concurrent commits, so the values
+    from the highest `tid` always win.
+    """
+    if current is None or action == "delete":
+        return action, data
+    current_action, current_data = current
+    if current_action == "delete":
+        # updating a deleted document ends up indexing the partial data
+        return "index", data
+    if _get_tid(data) < _get_tid(current_data):
+        # a newer write is already pending, it is applied on top
+        if current_action == "index":
+            return current
+        return action, _merge(data, current_data)
+    if action == "index":
+        return action, data
+    return current_action, _merge(current_data, data)
+
+
+def _merge(base, data):
+    """
+    Merge `data` on top of `base` the way elasticsearch applies a partial
+    update: objects are merged recursively, any other value is replaced
+    """
+    result = dict(base)
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            value = _merge(result[key], value)
+        result[key] = value
+    return result
+
+
+class IndexingQueue:
+    """
+    Catalog writes are queued and sent to elasticsearch in the background,
+    so commits do not wait on bulk requests.
+
+    Writes for the same document and target indexes are coalesced while they
+    are pending and documents from different commits are sent on the same
+    bulk requests. Once `max_size` documents are pending, new writes wait
+    until they are sent.
+
+    Writes that fail are queued again, under the writes queued meanwhile,
+    and sent after `retry_wait` seconds. After `max_attempts` they are logged
+    and counted in `failed`.
+    """
+
+    def __init__(self, utility, max_size=10000, wait=0.1, max_attempts=3, retry_wait=1):
+        self.utility = utility
+        self.max_size = max_size
+        self.wait = wait
+        self.max_attempts = max_attempts
+        self.retry_wait = retry_wait
+        self._pending = {}
+        # failed attempts of the writes queued again
+        self._attempts = {}
+        # search cache keys of the containers with pending writes
+        self._cache_keys = set()
+        self._lock = asyncio.Lock()
+        self._has_items = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._closed = False
+        self._task = None
+        # number of writes merged with a pending one
+        self.coalesced = 0
+        # number of writes dropped after `max_attempts`
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        self._closed = False
+        self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, indexes, action, datas, container=None):
+        """
+        Queue an index, update or delete of the documents in `datas`
+        (uuid -> data) for the target indexes. The search cache of
+        `container` is invalidated once they are sent.
+        """
+        while self.max_size and len(self._pending) >= self.max_size:
+            self._has_space.clear()
+            await self._has_space.wait()
+        indexes = tuple(indexes)
+        for ident, data in datas.items():
+            key = (indexes, ident)
+            current = self._pending.get(key)
+            if current is not None:
+                self.coalesced += 1
+            self._pending[key] = coalesce(current, action, data)
+        if container is not None:
+            self._cache_keys.add(get_container_cache_key(container))
+        self._has_items.set()
+
+    async def join(self):
+        """
+        Send every pending write
+        """
+        async with self._lock:
+            while len(self._pending) > 0:
+                pending = self._pending
+                cache_keys = self._cache_keys
+                self._pending = {}
+                self._cache_keys = set()
+                self._has_items.clear()
+                self._has_space.set()
+                if await self._send(pending, cache_keys):
+                    # give elasticsearch some time before sending them again
+                    await asyncio.sleep(self.retry_wait)
+
+    async def _send(self, pending, cache_keys=()):
+        """
+        Send the pending writes, returns whether some of them failed and were
+        queued again
+        """
+        groups = {}
+        for (indexes, ident), (action, data) in pending.items():
+            groups.setdefault((indexes, action), {})[ident] = data
+        failed = {}
+        for (indexes, action), datas in groups.items():
+            try:
+                if action == "delete":
+                    result = await self.utility._delete_documents(indexes, list(datas))
+                else:
+                    result = await self.utility._write_documents(
+                        indexes, datas, getattr(bulk_serializer, action)
+                    )
+            except Exception:
+                logger.error("Error sending queued catalog writes", exc_info=True)
+                failed_idents = list(datas)
+            else:
+                failed_idents = [
+                    failure["_id"] for failure in (result or {}).get("failed") or []
+                ]
+            for ident in failed_idents:
+                if ident in datas:
+                    failed[(indexes, ident)] = (action, datas[ident])
+        if self._attempts:
+            for key in pending:
+                if key not in failed:
+                    self._attempts.pop(key, None)
+        requeued = self._requeue(failed)
+        # results cached while the writes were pending are stale now
+        for cache_key in cache_keys:
+            self.utility.invalidate_search_cache_key(cache_key)
+        return requeued
+
+    def _requeue(self, failed):
+        requeued = False
+        for key, write in failed.items():
+            attempts = self._attempts.pop(key, 0) + 1
+            if attempts >= self.max_attempts:
+                self.failed += 1
+                logger.error(
+                    f"Dropping catalog write of {key[1]} on {key[0]} after "
+                    f"{attempts} attempts"
+                )
+                continue
+            self._attempts[key] = attempts
+            current = self._pending.get(key)
+            if current is not None:
+                # writes queued meanwhile are newer, they apply on top
+                write = coalesce(write, *current)
+            self._pending[key] = write
+            requeued = True
+        if requeued:
+            self._has_items.set()
+        return requeued
+
+    async def _run(self):
+        while not self._closed:
+            await self._has_items.wait()
+            if self.wait and not self._closed:
+                await asyncio.sleep(self.wait)
+            await self.join()
+
+    async def close(self):
+        """
+        Stop the background task once every pending write has been sent
+        """
+        self._closed = True
+        self._has_items.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.join()
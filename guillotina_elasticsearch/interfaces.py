@@ -76,9 +76,10 @@ class IConnectionFactoryUtility(Interface):
     container/request
     """
 
-    def get(loop=None):
+    def get(loop=None, purpose=None):
         """
-        Get a connection for a request
+        Get a connection for a request. `purpose` is only provided when a
+        dedicated connection is configured for it ("search" or "bulk")
         """
 
     async def close(loop=None):
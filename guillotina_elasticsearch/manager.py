@@ -9,6 +9,7 @@ from guillotina.utils import get_registry as guillotina_get_registry
 from guillotina_elasticsearch.interfaces import IIndexManager
 from guillotina_elasticsearch.schema import get_mappings
 from guillotina_elasticsearch.utils import get_migration_lock
+from guillotina_elasticsearch.utils import invalidate_index_name_cache
 
 import logging
 
@@ -112,6 +113,7 @@ class ContainerIndexManager:
         migration_index_name = self._get_index_name(index_name, next_version)
         registry["el_next_index_version"] = next_version
         registry.register()
+        self._invalidate_index_name_cache()
         return migration_index_name
 
     async def finish_migration(self):
@@ -123,6 +125,7 @@ class ContainerIndexManager:
         registry["el_index_version"] = next_version
         registry["el_next_index_version"] = None
         registry.register()
+        self._invalidate_index_name_cache()
 
     async def _get_version(self):
         registry = await self.get_registry()
@@ -140,6 +143,18 @@ class ContainerIndexManager:
         registry = await self.get_registry()
         registry["el_next_index_version"] = None
         registry.register()
+        self._invalidate_index_name_cache()
+
+    def _invalidate_index_name_cache(self):
+        invalidate_index_name_cache(self.context)
+
+        def after_commit(status):
+            # registry changes are only visible to others once committed
+            invalidate_index_name_cache(self.context)
+
+        txn = get_transaction()
+        if txn is not None:
+            txn.add_after_commit_hook(after_commit)
 
     async def get_schemas(self):
         pass
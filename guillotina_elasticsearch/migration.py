@@ -20,9 +20,13 @@ from guillotina.utils import get_authenticated_user
 from guillotina.utils import get_content_path
 from guillotina.utils import get_current_container
 from guillotina.utils import get_current_transaction
+from guillotina.utils import get_object_by_uid
 from guillotina.utils import get_security_policy
+from guillotina_elasticsearch.bulk import bulk_serializer
+from guillotina_elasticsearch.bulk import get_bulk_body
 from guillotina_elasticsearch.events import IndexProgress
 from guillotina_elasticsearch.interfaces import IIndexManager
+from guillotina_elasticsearch.uids import UidStore
 from guillotina_elasticsearch.utils import get_migration_lock
 from guillotina_elasticsearch.utils import noop_response
 
@@ -33,6 +37,7 @@ import gc
 import json
 import logging
 import resource
+import sys
 import time
 
 
@@ -144,6 +149,12 @@ class Migrator:
         index_manager=None,
         children_only=False,
         cache=True,
+        bulk_max_bytes=None,
+        workers=1,
+        load_batch_size=100,
+        uids_db=None,
+        resume=False,
+        checkpoint_interval=60,
     ):
         self.utility = utility
         self.context = context
@@ -153,12 +164,22 @@ class Migrator:
         self.log_details = log_details
         self.memory_tracking = memory_tracking
         self.bulk_size = bulk_size
+        if bulk_max_bytes is None:
+            bulk_max_bytes = getattr(utility, "bulk_max_bytes", None)
+        self.bulk_max_bytes = bulk_max_bytes
         self.reindex_security = reindex_security
         self.children_only = children_only
         if mapping_only and full:
             raise Exception("Can not do a full reindex and a mapping only migration")
         self.mapping_only = mapping_only
 
+        # number of folders crawled concurrently, each on its own transaction
+        self.workers = max(workers or 1, 1)
+        self._crawl_queue = None
+        # children loaded from the db at once
+        self.load_batch_size = max(load_batch_size or 1, 1)
+        self.cache = cache
+
         self.txn = get_current_transaction()
         if not cache:
             # make sure that we don't cache requests...
@@ -178,11 +199,35 @@ class Migrator:
         self.indexer = Indexer()
 
         self.batch = {}
+        self.batch_bytes = 0
+        self.last_batch_size = None
         self.indexed = 0
         self.processed = 0
-        self.missing = []
-        self.orphaned = []
-        self.existing = []
+        if resume and not uids_db:
+            raise Exception("Can not resume a migration without a uids db")
+        self.resume = resume
+        # seconds between checkpoints, they are saved on the uids db
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = time.time()
+        self._checkpointing = False
+        # uuids of the folders queued or being crawled
+        self._crawl_pending = set()
+        self._crawl_done = False
+
+        self.uids_store = None
+        if uids_db:
+            # keep the uid sets on disk instead of in memory
+            self.uids_store = UidStore(uids_db)
+            clear = not resume
+            if clear:
+                self.uids_store.clear_checkpoint()
+            self.missing = self.uids_store.get_set("missing", clear=clear)
+            self.orphaned = self.uids_store.get_set("orphaned", clear=clear)
+            self.existing = self.uids_store.get_set("existing", clear=clear)
+        else:
+            self.missing = []
+            self.orphaned = []
+            self.existing = set()
         self.errors = []
         self.mapping_diff = {}
         self.start_time = self.index_start_time = time.time()
@@ -197,6 +242,21 @@ class Migrator:
     def per_sec(self):
         return self.processed / (time.time() - self.index_start_time)
 
+    def get_uids_memory(self):
+        """
+        Estimated memory used by the existing, missing and orphaned uids
+        """
+        total = 0
+        for uids in (self.existing, self.missing, self.orphaned):
+            if not isinstance(uids, (set, list)):
+                # stored on disk
+                continue
+            total += sys.getsizeof(uids)
+            if len(uids) > 0:
+                # all uids have the same size, avoid going through them
+                total += len(uids) * sys.getsizeof(next(iter(uids)))
+        return total
+
     async def create_next_index(self):
         async with transaction(adopt_parent_txn=True) as txn:
             await txn.refresh(await self.index_manager.get_registry())
@@ -250,10 +310,15 @@ class Migrator:
         else:
             self.response.write(f"Unknown state for task {task_id}")
 
-    async def get_all_uids(self):
+    async def get_all_uids(self, ids=None):
+        """
+        Add the ids of the documents on the index to `ids`, a new set by
+        default
+        """
         self.response.write("Retrieving existing doc ids")
         page_size = 3000
-        ids = []
+        if ids is None:
+            ids = set()
         index_name = await self.index_manager.get_index_name()
         result = await self.conn.search(
             index=index_name,
@@ -263,13 +328,13 @@ class Migrator:
             _source=False,
             body={"sort": ["_doc"]},
         )
-        ids.extend([r["_id"] for r in result["hits"]["hits"]])
+        ids.update(r["_id"] for r in result["hits"]["hits"])
         scroll_id = result["_scroll_id"]
         while scroll_id:
             result = await self.conn.scroll(scroll_id=scroll_id, scroll="2m")
             if len(result["hits"]["hits"]) == 0:
                 break
-            ids.extend([r["_id"] for r in result["hits"]["hits"]])
+            ids.update(r["_id"] for r in result["hits"]["hits"])
             self.response.write(f"Retrieved {len(ids)} doc ids")
             scroll_id = result["_scroll_id"]
         self.response.write(f"Retrieved {len(ids)}. Copied {self.copied_docs} docs")
@@ -306,16 +371,106 @@ class Migrator:
         return new_definitions
 
     async def process_folder(self, ob):
+        if self._crawl_queue is not None:
+            # a crawl worker processes it
+            self._crawl_pending.add(ob.uuid)
+            self._crawl_queue.put_nowait(ob)
+            return
+        if self.workers > 1 or self.uids_store is not None:
+            # the crawl queue is what is saved on checkpoints
+            await self.crawl(ob)
+            return
+        await self.process_children(ob)
+
+    async def crawl(self, *folders):
+        """
+        Process the subtrees of the folders with `self.workers` concurrent
+        workers. Subfolders are queued and crawled by the first available
+        worker
+        """
+        queue = self._crawl_queue = asyncio.LifoQueue()
+        for folder in folders:
+            self._crawl_pending.add(folder.uuid)
+            queue.put_nowait(folder)
+        del folders
+        workers = [
+            asyncio.ensure_future(self._crawl_worker(queue))
+            for _ in range(self.workers)
+        ]
+        join = asyncio.ensure_future(queue.join())
+        try:
+            done, _ = await asyncio.wait(
+                [join] + workers, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                # raise worker errors
+                task.result()
+        finally:
+            self._crawl_queue = None
+            self._crawl_pending.clear()
+            join.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(join, *workers, return_exceptions=True)
+
+    async def _crawl_worker(self, queue):
+        async with transaction(read_only=True, abort_when_done=True) as txn:
+            if not self.cache:
+                txn._cache = DummyCache(txn)
+            while True:
+                ob = await queue.get()
+                try:
+                    await self.process_children(ob)
+                    self._crawl_pending.discard(ob.uuid)
+                finally:
+                    del ob
+                    queue.task_done()
+
+    async def get_children(self, ob, keys):
+        """
+        Load the children of the folder in `keys`, the ones not in the
+        transaction cache with a single storage query
+        """
+        # txn.get_children does the same but sends at most 16 keys per query,
+        # the whole page is loaded at once here
         txn = get_current_transaction()
-        for key in await ob.async_keys():
+        cache = txn._cache
+        records = []
+        missing = []
+        for key in keys:
+            record = await cache.get(container=ob, id=key)
+            if record is None:
+                missing.append(key)
+            else:
+                records.append(record)
+        if len(missing) > 0:
+            for record in await txn._manager._storage.get_children(
+                txn, ob.__uuid__, missing
+            ):
+                if len(record["state"]) < cache.max_cache_record_size:
+                    await cache.set(record, container=ob, id=record["id"])
+                records.append(record)
+        children = []
+        for record in records:
             try:
-                item = await txn.get_child(ob, key)
-            except (KeyError, ModuleNotFoundError):
-                continue
-            if item is None:
+                children.append(txn._fill_object(record, ob))
+            except ModuleNotFoundError:
+                # a child of an unknown type
                 continue
-            await self.process_object(item)
-            del item
+        return children
+
+    async def process_children(self, ob):
+        keys = await ob.async_keys()
+        for idx in range(0, len(keys), self.load_batch_size):
+            children = await self.get_children(
+                ob, keys[idx : idx + self.load_batch_size]
+            )
+            # release the objects as they are processed
+            children.reverse()
+            while children:
+                item = children.pop()
+                await self.process_object(item)
+                del item
 
         del ob
 
@@ -331,11 +486,11 @@ class Migrator:
             - remove for list of existing doc ids
         """
         full = False
-        if ob.uuid not in self.existing:
+        if ob.uuid in self.existing:
+            self.existing.discard(ob.uuid)
+        else:
             self.missing.append(ob.uuid)
             full = True
-        else:
-            self.existing.remove(ob.uuid)
         await self.index_object(ob, full=full)
         self.processed += 1
 
@@ -377,7 +532,9 @@ class Migrator:
         if ob.__serial__:
             data["tid"] = ob.__serial__
         self.indexed += 1
-        self.batch[ob.uuid] = {"action": batch_type, "data": data}
+        encoded = bulk_serializer.encode(data)
+        self.batch[ob.uuid] = {"action": batch_type, "data": data, "encoded": encoded}
+        self.batch_bytes += len(encoded)
 
         if self.log_details:
             self.response.write(
@@ -405,7 +562,23 @@ class Migrator:
                 b"Indexing new batch, totals: (%d %d/sec)\n"
                 % (self.indexed, int(self.per_sec()))  # noqa
             )
-        if len(self.batch) >= self.bulk_size:
+            self.response.write(
+                b"Uids in memory: %d existing, %d missing, %d orphaned, %.2f MB\n"
+                % (
+                    len(self.existing),
+                    len(self.missing),
+                    len(self.orphaned),
+                    self.get_uids_memory() / 1024.0 / 1024.0,
+                )
+            )
+            if self.last_batch_size is not None:
+                docs, size = self.last_batch_size
+                self.response.write(
+                    b"Last batch size: %d docs, %d bytes\n" % (docs, size)
+                )
+        if len(self.batch) >= self.bulk_size or (
+            self.bulk_max_bytes and self.batch_bytes >= self.bulk_max_bytes
+        ):
             await notify(
                 IndexProgress(
                     self.context,
@@ -415,6 +588,11 @@ class Migrator:
                 )
             )
             await self.flush()
+        if (
+            self.uids_store is not None
+            and time.time() - self._last_checkpoint >= self.checkpoint_interval
+        ):
+            await self.checkpoint()
 
     async def join_futures(self):
         for future in self.reindex_futures:
@@ -429,18 +607,28 @@ class Migrator:
         max_tries=5,
     )
     async def _index_batch(self, batch):
-        bulk_data = []
+        operations = []
         for _id, payload in batch.items():
             index = payload.pop("__index__", self.work_index_name)
-            action_data = {"_index": index, "_id": _id}
-            data = payload["data"]
-            if payload["action"] == "update":
-                data = {"doc": data}
-                action_data["retry_on_conflict"] = 3
-            bulk_data.append({payload["action"]: action_data})
-            if payload["action"] != "delete":
-                bulk_data.append(data)
-        results = await self.conn.bulk(index=self.work_index_name, body=bulk_data)
+            action = payload["action"]
+            if action == "delete":
+                operations.append(bulk_serializer.delete(index, _id))
+            elif action == "update":
+                operations.append(
+                    bulk_serializer.update(
+                        index, _id, payload["data"], encoded=payload.get("encoded")
+                    )
+                )
+            else:
+                operations.append(
+                    bulk_serializer.index(
+                        index, _id, payload["data"], encoded=payload.get("encoded")
+                    )
+                )
+        conn = self.utility.get_connection("bulk")
+        results = await conn.bulk(
+            index=self.work_index_name, body=get_bulk_body(operations)
+        )
         if results["errors"]:
             errors = []
             for result in results["items"]:
@@ -454,6 +642,9 @@ class Migrator:
                         if value["status"] in (409, 429):
                             self.batch[_id] = batch[_id]
                         elif value["status"] == 404:
+                            if key == "delete":
+                                # already deleted
+                                continue
                             self.batch[_id] = batch[_id]
                             self.batch[_id]["action"] = "index"
                         else:
@@ -467,8 +658,13 @@ class Migrator:
             # nothing to flush
             return
 
+        self.last_batch_size = (len(self.batch), self.batch_bytes)
+        logger.debug(
+            f"Sending bulk batch: {len(self.batch)} docs, {self.batch_bytes} bytes"
+        )
         future = asyncio.ensure_future(self._index_batch(self.batch))
         self.batch = {}
+        self.batch_bytes = 0
         self.reindex_futures.append(future)
 
         if len(self.reindex_futures) > 7:
@@ -497,6 +693,94 @@ class Migrator:
                 # doing something about it another time...
                 self.errors.append({"type": "unprocessed", "uuid": uuid})
 
+    async def checkpoint(self, uids_loaded=True):
+        """
+        Save the progress of the migration on the uids store, so it can be
+        resumed. Only the work sent to elasticsearch is considered done.
+        """
+        if self.uids_store is None or self._checkpointing:
+            return
+        self._checkpointing = True
+        try:
+            if self._crawl_queue is not None:
+                # folders still to crawl, they are crawled again on resume
+                frontier = list(self._crawl_pending)
+            elif self._crawl_done:
+                frontier = []
+            else:
+                # crawl from the start
+                frontier = None
+            await self.flush()
+            await self.join_futures()
+            self.uids_store.set_checkpoint(
+                {
+                    "container": self.container.id,
+                    "work_index_name": self.work_index_name,
+                    "mapping_diff": self.mapping_diff,
+                    "uids_loaded": uids_loaded,
+                    "frontier": frontier,
+                    "processed": self.processed,
+                    "indexed": self.indexed,
+                }
+            )
+            self._last_checkpoint = time.time()
+        finally:
+            self._checkpointing = False
+
+    async def load_checkpoint(self):
+        checkpoint = self.uids_store.get_checkpoint()
+        if checkpoint is None:
+            raise Exception("No migration checkpoint to resume")
+        if checkpoint["container"] != self.container.id:
+            raise Exception(
+                f"Migration checkpoint is for container {checkpoint['container']}"
+            )
+        self.work_index_name = checkpoint["work_index_name"]
+        if await self.index_manager.get_migration_index_name() != self.work_index_name:
+            raise Exception(
+                f"Migration to {self.work_index_name} is no longer in progress"
+            )
+        if not await self.conn.indices.exists(index=self.work_index_name):
+            raise Exception(f"Migration index {self.work_index_name} not found")
+        self.mapping_diff = checkpoint["mapping_diff"]
+        self.processed = checkpoint["processed"]
+        self.indexed = checkpoint["indexed"]
+        frontier = checkpoint["frontier"]
+        self.response.write(
+            f"Resuming migration to {self.work_index_name}, processed: "
+            f"{self.processed}, folders to crawl: "
+            f"{'all' if frontier is None else len(frontier)}"
+        )
+        return checkpoint
+
+    async def resume_crawl(self, frontier):
+        folders = []
+        txn = get_current_transaction()
+        for uuid in frontier:
+            try:
+                folders.append(await get_object_by_uid(uuid, txn))
+            except KeyError:
+                # deleted in the meantime
+                continue
+        await self.crawl(*folders)
+
+    def close_uids_store(self):
+        """
+        The uids file is kept when the migration did not finish
+        """
+        if self.uids_store is not None:
+            self.uids_store.close(remove=self.status in ("done", "canceled"))
+
+    async def wait_index_name_cache(self):
+        """
+        Other processes can keep using their cached list of indexes to write
+        to until it expires
+        """
+        ttl = getattr(self.utility, "index_name_cache_ttl", None)
+        if ttl:
+            self.response.write(f"Waiting {ttl} seconds for index name caches")
+            await asyncio.sleep(ttl)
+
     async def setup_next_index(self):
         self.response.write(b"Creating new index")
         async with get_migration_lock(await self.index_manager.get_index_name()):
@@ -509,6 +793,7 @@ class Migrator:
         async with transaction(adopt_parent_txn=True):
             await self.index_manager.cancel_migration()
             self.response.write("Next index disabled")
+        await self.wait_index_name_cache()
         if self.active_task_id is not None:
             self.response.write("Canceling copy of index task")
             await self.conn.tasks.cancel(self.active_task_id)
@@ -516,43 +801,59 @@ class Migrator:
         if self.work_index_name:
             self.response.write("Deleting new index")
             await self.conn.indices.delete(index=self.work_index_name)
+        self.status = "canceled"
+        self.close_uids_store()
         self.response.write("Migration canceled")
 
     async def run_migration(self):
         alias_index_name = await self.index_manager.get_index_name()
         existing_index = await self.index_manager.get_real_index_name()
 
-        await self.setup_next_index()
-
-        self.mapping_diff = await self.calculate_mapping_diff()
-        diff = json.dumps(
-            self.mapping_diff, sort_keys=True, indent=4, separators=(",", ": ")
-        )
-        self.response.write(f"Caculated mapping diff: {diff}")
+        checkpoint = None
+        if self.resume:
+            checkpoint = await self.load_checkpoint()
+        else:
+            await self.setup_next_index()
+            await self.wait_index_name_cache()
 
-        if not self.full:
-            # if full, we're reindexing everything does not matter what
-            # anyways, so skip
-            self.response.write(
-                f"Copying initial index {existing_index} "
-                f"into {self.work_index_name}"
+            self.mapping_diff = await self.calculate_mapping_diff()
+            diff = json.dumps(
+                self.mapping_diff, sort_keys=True, indent=4, separators=(",", ": ")
             )
-            try:
-                await self.copy_to_next_index()
-                self.response.write("Copying initial index data finished")
-            except elasticsearch.exceptions.NotFoundError:
-                self.response.write("No initial index to copy to")
+            self.response.write(f"Caculated mapping diff: {diff}")
+
+            if not self.full:
+                # if full, we're reindexing everything does not matter what
+                # anyways, so skip
+                self.response.write(
+                    f"Copying initial index {existing_index} "
+                    f"into {self.work_index_name}"
+                )
+                try:
+                    await self.copy_to_next_index()
+                    self.response.write("Copying initial index data finished")
+                except elasticsearch.exceptions.NotFoundError:
+                    self.response.write("No initial index to copy to")
+            await self.checkpoint(uids_loaded=False)
         if not self.mapping_only:
-            try:
-                self.existing = await self.get_all_uids()
-            except elasticsearch.exceptions.NotFoundError:
-                pass
+            if checkpoint is None or not checkpoint["uids_loaded"]:
+                try:
+                    await self.get_all_uids(self.existing)
+                except elasticsearch.exceptions.NotFoundError:
+                    pass
+                await self.checkpoint()
 
             self.index_start_time = time.time()
-            if self.children_only or IContainer.providedBy(self.context):
-                await self.process_folder(self.context)  # this is recursive
-            else:
-                await self.process_object(self.context)  # this is recursive
+            frontier = checkpoint["frontier"] if checkpoint else None
+            if frontier is None:
+                if self.children_only or IContainer.providedBy(self.context):
+                    await self.process_folder(self.context)  # this is recursive
+                else:
+                    await self.process_object(self.context)  # this is recursive
+            elif len(frontier) > 0:
+                await self.resume_crawl(frontier)
+            self._crawl_done = True
+            await self.checkpoint()
 
             await self.check_existing()
 
@@ -605,3 +906,4 @@ class Migrator:
             self.response.write("Old index deleted")
         except elasticsearch.exceptions.NotFoundError:
             pass
+        self.close_uids_store()
@@ -1,15 +1,20 @@
 # https://docs.google.com/document/d/1xooubzJKBnUzVlsa2f0GSwvuE1oir9hUdWUf1SU9S6E/edit
 from dateutil.parser import parse
 from dateutil.parser import ParserError
+from guillotina import app_settings
 from guillotina import configure
 from guillotina.catalog.parser import BaseParser
 from guillotina.catalog.utils import get_index_definition
 from guillotina.interfaces import IResource
 from guillotina.interfaces import ISearchParser
+from guillotina.utils import get_content_path
 from guillotina_elasticsearch.interfaces import IElasticSearchUtility
 from guillotina_elasticsearch.interfaces import ParsedQueryInfo
+from guillotina_elasticsearch.utils import decode_cursor
+from lru import LRU  # pylint: disable=E0611
 
 import logging
+import orjson
 import typing
 import urllib.parse
 
@@ -17,6 +22,8 @@ import urllib.parse
 logger = logging.getLogger("guillotina_cms")
 
 MAX_AGGS = 20
+FILTER_CLAUSES = ("term", "terms", "range", "exists", "wildcard")
+PIT_KEEP_ALIVE = "1m"
 SEARCH_DATA_FIELDS = [
     "contributors",
     "creation_date",
@@ -31,6 +38,11 @@ SEARCH_DATA_FIELDS = [
     "uuid",
 ]
 
+# param name -> field descriptor, the names come from requests so it is bounded
+_field_descriptors = LRU(1024)
+# identical queries on the same context -> serialized parsed query
+_parse_cache = None
+
 
 def convert(value):
     # XXX: Check for possible json injection
@@ -62,7 +74,7 @@ def process_compound_field(field, value, operator):
         if result is None:
             continue
         match_type, sub_part = result
-        query[match_type].append(sub_part)
+        add_clause(query, match_type, sub_part)
 
     if len(query["should"]) == 0:
         del query["should"]
@@ -71,15 +83,44 @@ def process_compound_field(field, value, operator):
     return "must", {"bool": query}
 
 
-def process_field(field, value):
-    if field.endswith("__or"):
-        return process_compound_field(field, value, "or")
-    elif field.endswith("__and"):
-        field = field[: -len("__and")]
-        return process_compound_field(field, value, "and")
+def is_filter_clause(clause):
+    """
+    Clauses that do not need to be scored, a bool clause is when all its
+    scoring clauses are
+    """
+    name, value = next(iter(clause.items()))
+    if name == "bool":
+        return all(
+            is_filter_clause(sub_clause)
+            for sub_clause in value.get("must", []) + value.get("should", [])
+        )
+    if name not in FILTER_CLAUSES:
+        return False
+    # boosted clauses need to be scored
+    return not any(
+        isinstance(field_value, dict) and "boost" in field_value
+        for field_value in value.values()
+    )
+
+
+def add_clause(query, match_type, clause):
+    """
+    Add the clause to the bool query, `must` clauses that do not need to be
+    scored are added in filter context, so elasticsearch can cache them
+    """
+    if (
+        match_type == "must"
+        and app_settings.get("elasticsearch", {}).get("filter_context", True)
+        and is_filter_clause(clause)
+    ):
+        match_type = "filter"
+    query.setdefault(match_type, []).append(clause)
 
-    modifier = None
 
+MODIFIERS = ("not", "in", "eq", "gt", "lt", "gte", "lte", "wildcard", "starts")
+
+
+def _get_field_descriptor(field):
     match_type = "must"
     if "__should" in field:
         match_type = "should"
@@ -87,33 +128,12 @@ def process_field(field, value):
     field, _, boost = urllib.parse.unquote(field).partition("^")
     boost = float(boost) if boost else None
 
-    if field.endswith("__not"):
-        modifier = "not"
-        field = field[: -len("__not")]
-    elif field.endswith("__in"):
-        modifier = "in"
-        field = field[: -len("__in")]
-    elif field.endswith("__eq"):
-        modifier = "eq"
-        field = field[: -len("__eq")]
-    elif field.endswith("__gt"):
-        modifier = "gt"
-        field = field[: -len("__gt")]
-    elif field.endswith("__lt"):
-        modifier = "lt"
-        field = field[: -len("__lt")]
-    elif field.endswith("__gte"):
-        modifier = "gte"
-        field = field[: -len("__gte")]
-    elif field.endswith("__lte"):
-        modifier = "lte"
-        field = field[: -len("__lte")]
-    elif field.endswith("__wildcard"):
-        modifier = "wildcard"
-        field = field[: -len("__wildcard")]
-    elif field.endswith("__starts"):
-        modifier = "starts"
-        field = field[: -len("__starts")]
+    modifier = None
+    for name in MODIFIERS:
+        if field.endswith(f"__{name}"):
+            modifier = name
+            field = field[: -len(name) - 2]
+            break
 
     index = get_index_definition(field)
     if "." in field:
@@ -132,6 +152,52 @@ def process_field(field, value):
         _type = index["type"]
     else:
         return
+    return match_type, field, boost, modifier, _type
+
+
+def get_field_descriptor(field):
+    """
+    Resolve a query param name to (match_type, field, boost, modifier, type),
+    None when the field is not indexed. Results are memoized per param name.
+    """
+    try:
+        return _field_descriptors[field]
+    except KeyError:
+        pass
+    descriptor = _field_descriptors[field] = _get_field_descriptor(field)
+    return descriptor
+
+
+def _get_parse_cache():
+    global _parse_cache
+    if _parse_cache is None:
+        size = app_settings.get("elasticsearch", {}).get("parse_cache_size", 1000)
+        if not size:
+            return None
+        _parse_cache = LRU(size)
+    return _parse_cache
+
+
+def invalidate_parse_cache():
+    """
+    Needs to be called when the index definitions change
+    """
+    _field_descriptors.clear()
+    if _parse_cache is not None:
+        _parse_cache.clear()
+
+
+def process_field(field, value):
+    if field.endswith("__or"):
+        return process_compound_field(field, value, "or")
+    elif field.endswith("__and"):
+        field = field[: -len("__and")]
+        return process_compound_field(field, value, "and")
+
+    descriptor = get_field_descriptor(field)
+    if descriptor is None:
+        return
+    match_type, field, boost, modifier, _type = descriptor
     if not isinstance(value, list):
         value = [value]
         term_keyword = "term"
@@ -264,6 +330,43 @@ def _mm_to_clause(g):
     return {"multi_match": mm}, g.get("mode", "must")
 
 
+def get_fields_projection(fields):
+    """
+    Split the fields to return in the ones read from stored fields and the
+    ones that have to be read from `_source`, because they are not stored
+    """
+    stored_fields = []
+    source_fields = []
+    for field in fields:
+        if field in stored_fields or field in source_fields:
+            continue
+        if "*" in field or (get_index_definition(field) or {}).get("store"):
+            stored_fields.append(field)
+        else:
+            source_fields.append(field)
+    return stored_fields, source_fields
+
+
+def parse_track_total_hits(value):
+    """
+    `_track_total_hits` param: true, false or the number of hits to count
+    accurately
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().lower()
+    if value in ("true", "yes", "1"):
+        return True
+    if value in ("false", "no", "0"):
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
 def process_query_level(params):
     query = {
         "must": [],
@@ -275,7 +378,7 @@ def process_query_level(params):
         result = process_field(field, value)
         if result is not None:
             match_type, sub_part = result
-            query[match_type].append(sub_part)
+            add_clause(query, match_type, sub_part)
 
     if len(query["should"]) == 0:
         del query["should"]
@@ -288,12 +391,46 @@ def process_query_level(params):
 )
 class Parser(BaseParser):
     def __call__(self, params: typing.Dict) -> ParsedQueryInfo:
+        cache = _get_parse_cache()
+        key = None
+        if cache is not None and "_cursor" not in params:
+            try:
+                key = (
+                    get_content_path(self.context) if self.context else None,
+                    orjson.dumps(params, option=orjson.OPT_SORT_KEYS),
+                )
+            except TypeError:
+                pass
+            else:
+                try:
+                    return orjson.loads(cache[key])
+                except KeyError:
+                    pass
+        query = self.parse(params)
+        if key is not None:
+            cache[key] = orjson.dumps(query)
+        return query
+
+    def parse(self, params: typing.Dict) -> ParsedQueryInfo:
+        track_total_hits = parse_track_total_hits(params.pop("_track_total_hits", None))
+        cursor = params.pop("_cursor", None)
+        pit = params.pop("_pit", None)
+        metadata_only = params.pop("_metadata_only", None) in ("true", "True", True)
         query_info = super().__call__(params)
-        metadata = query_info.get("metadata", [])
-        if metadata:
-            search_data = SEARCH_DATA_FIELDS + metadata
+        metadata = query_info.get("metadata") or []
+        if metadata_only:
+            # minimal projection, path is needed for the urls of the items
+            search_data = ["path"] + metadata
         else:
-            search_data = SEARCH_DATA_FIELDS
+            search_data = SEARCH_DATA_FIELDS + metadata
+        excluded_metadata = query_info.get("excluded_metadata")
+        if excluded_metadata:
+            search_data = [
+                field
+                for field in search_data
+                if field not in excluded_metadata or field == "path"
+            ]
+        stored_fields, source_fields = get_fields_projection(search_data)
         groups = _collect_mm_groups(query_info["params"])
         bool_q = process_query_level(query_info["params"])
         if groups != {}:
@@ -303,7 +440,8 @@ class Parser(BaseParser):
             else:
                 bool_q.setdefault("must", []).append(clause)
         query = {
-            "stored_fields": search_data,
+            "stored_fields": stored_fields,
+            "_source": {"includes": source_fields} if source_fields else False,
             "query": {"bool": bool_q},
             "sort": [],
         }
@@ -314,4 +452,21 @@ class Parser(BaseParser):
         query["sort"].append({"_id": "desc"})
         query["from"] = query_info.get("_from", 0)
         query["size"] = query_info.get("size", 0)
+        if track_total_hits is not None:
+            query["track_total_hits"] = track_total_hits
+        if pit in ("true", "True", True):
+            pit = PIT_KEEP_ALIVE
+        if cursor:
+            # search_after pagination, `from` can not be used
+            cursor = decode_cursor(cursor)
+            query["search_after"] = cursor["search_after"]
+            del query["from"]
+            if cursor.get("pit"):
+                query["pit"] = {
+                    "id": cursor["pit"],
+                    "keep_alive": pit or cursor.get("keep_alive") or PIT_KEEP_ALIVE,
+                }
+        elif pit:
+            # search_raw opens the point in time
+            query["pit"] = {"keep_alive": pit}
         return typing.cast(ParsedQueryInfo, query)
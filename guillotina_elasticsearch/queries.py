@@ -1,26 +1,98 @@
+from guillotina import app_settings
+from guillotina import configure
+from guillotina.interfaces import IObjectModifiedEvent
+from guillotina.interfaces import IObjectRemovedEvent
+from guillotina.interfaces import IPrincipal
 from guillotina.utils import get_authenticated_user
 from guillotina.utils import get_security_policy
+from lru import LRU  # pylint: disable=E0611
 
+import time
+
+
+_principals_cache = None
+_principals_cache_version = 0
+
+
+def _get_principals_cache():
+    global _principals_cache
+    if _principals_cache is None:
+        size = app_settings.get("elasticsearch", {}).get(
+            "security_query_cache_size", 1000
+        )
+        if not size:
+            return None
+        _principals_cache = LRU(size)
+    return _principals_cache
+
+
+def invalidate_security_query_cache():
+    """
+    Needs to be called when the global roles of users or groups change
+    """
+    global _principals_cache_version
+    _principals_cache_version += 1
+    if _principals_cache is not None:
+        _principals_cache.clear()
+
+
+@configure.subscriber(for_=(IPrincipal, IObjectModifiedEvent))
+@configure.subscriber(for_=(IPrincipal, IObjectRemovedEvent))
+async def principal_changed(principal, event):
+    # the roles of a group apply to every cached user in it
+    invalidate_security_query_cache()
+
+
+def get_security_principals(user, policy):
+    """
+    Return the roles and the users (user and groups) that can access content
+    for the user. Results are cached per user id, groups and global roles
+    for `security_query_cache_ttl` seconds, as the roles of the groups can
+    change in other processes.
+    """
+    cache = _get_principals_cache()
+    key = None
+    if cache is not None:
+        key = (
+            _principals_cache_version,
+            type(policy),
+            user.id,
+            tuple(user.groups),
+            tuple(sorted((getattr(user, "roles", None) or {}).items())),
+        )
+        try:
+            expires, result = cache[key]
+            if expires > time.monotonic():
+                return result
+        except KeyError:
+            pass
 
-async def build_security_query(container):
     # The users who has plone.AccessContent permission by prinperm
     # The roles who has plone.AccessContent permission by roleperm
-    users = []
-    roles = []
-    user = get_authenticated_user()
-    policy = get_security_policy(user)
-
-    users.append(user.id)
+    users = [user.id]
     users.extend(user.groups)
 
     roles_dict = policy.global_principal_roles(user.id, user.groups)
-    roles.extend([key for key, value in roles_dict.items() if value])
+    roles = [key for key, value in roles_dict.items() if value]
+
+    result = (tuple(roles), tuple(users))
+    if key is not None:
+        ttl = app_settings.get("elasticsearch", {}).get("security_query_cache_ttl", 5)
+        cache[key] = (time.monotonic() + ttl, result)
+    return result
 
-    # We got all users and roles
-    # users: users and groups
 
-    should_list = [{"match": {"access_roles": x}} for x in roles]
-    should_list.extend([{"match": {"access_users": x}} for x in users])
+async def build_security_query(container):
+    user = get_authenticated_user()
+    policy = get_security_policy(user)
+    roles, users = get_security_principals(user, policy)
+
+    # users: users and groups
+    should_list = []
+    if roles:
+        should_list.append({"terms": {"access_roles": list(roles)}})
+    if users:
+        should_list.append({"terms": {"access_users": list(users)}})
 
     return {
         "query": {
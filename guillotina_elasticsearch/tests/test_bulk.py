@@ -0,0 +1,322 @@
+from guillotina_elasticsearch.bulk import bulk_serializer
+from guillotina_elasticsearch.bulk import BulkWriter
+from guillotina_elasticsearch.bulk import merge_bulk_results
+from guillotina_elasticsearch.utility import ElasticSearchUtility
+
+import asyncio
+import json
+import pytest
+
+
+class FakeUtility:
+    bulk_concurrency = 2
+    bulk_size = 50
+    bulk_max_bytes = None
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sent = []
+
+    async def bulk_insert(self, bulk_data, idents, count=0, response=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            self.sent.append(idents)
+            return {
+                "took": 1,
+                "errors": False,
+                "items": [{"index": {"_id": _id, "status": 201}} for _id in idents],
+            }
+        finally:
+            self.in_flight -= 1
+
+    def log_result(self, result, label="ES Query"):
+        pass
+
+
+async def test_bulk_writer_bounds_in_flight_requests():
+    utility = FakeUtility()
+    writer = BulkWriter(utility)
+    for idx in range(6):
+        await writer.send([], [f"doc{idx}"])
+    result = await writer.close()
+
+    assert utility.max_in_flight == 2
+    assert result["took"] == 6
+    assert result["errors"] is False
+    assert [item["index"]["_id"] for item in result["items"]] == [
+        f"doc{idx}" for idx in range(6)
+    ]
+
+
+async def test_bulk_writer_raises_request_errors():
+    class FailingUtility(FakeUtility):
+        async def bulk_insert(self, bulk_data, idents, count=0, response=None):
+            raise ValueError("failed")
+
+    writer = BulkWriter(FailingUtility(), concurrency=1)
+    await writer.send([], ["doc"])
+    with pytest.raises(ValueError):
+        await writer.close()
+
+
+def test_merge_bulk_results():
+    result = merge_bulk_results(
+        [
+            {"took": 2, "errors": False, "items": [{"index": {"_id": "a"}}]},
+            {},
+            {"took": 3, "errors": True, "items": [{"index": {"_id": "b"}}]},
+        ]
+    )
+    assert result == {
+        "took": 5,
+        "errors": True,
+        "items": [{"index": {"_id": "a"}}, {"index": {"_id": "b"}}],
+        "failed": [],
+        "retried": 0,
+    }
+
+
+async def test_bulk_writer_flushes_by_doc_count():
+    utility = FakeUtility()
+    writer = BulkWriter(utility, max_docs=2)
+    for idx in range(5):
+        await writer.add(f"doc{idx}", [bulk_serializer.index("foo", f"doc{idx}", {})])
+    result = await writer.close()
+    assert utility.sent == [["doc0", "doc1"], ["doc2", "doc3"], ["doc4"]]
+    assert [batch["docs"] for batch in result["batches"]] == [2, 2, 1]
+
+
+async def test_bulk_writer_flushes_by_byte_size():
+    utility = FakeUtility()
+    doc = {"title": "x" * 100}
+    doc_size = len(bulk_serializer.index("foo", "doc0", doc))
+    writer = BulkWriter(utility, max_docs=100, max_bytes=doc_size * 2 + 10)
+    for idx in range(5):
+        await writer.add(f"doc{idx}", [bulk_serializer.index("foo", f"doc{idx}", doc)])
+    result = await writer.close()
+    assert utility.sent == [["doc0", "doc1"], ["doc2", "doc3"], ["doc4"]]
+    assert result["batches"][0] == {"docs": 2, "bytes": doc_size * 2}
+
+
+async def test_bulk_writer_flush_all_sends_single_request():
+    utility = FakeUtility()
+    writer = BulkWriter(utility, flush_all=True)
+    for idx in range(120):
+        await writer.add(f"doc{idx}", [bulk_serializer.index("foo", f"doc{idx}", {})])
+    await writer.close()
+    assert len(utility.sent) == 1
+    assert len(utility.sent[0]) == 120
+
+
+class FakeBulkConnection:
+    def __init__(self, responses):
+        self.responses = responses
+        self.bodies = []
+
+    async def bulk(self, body, refresh=None):
+        self.bodies.append(body)
+        statuses = self.responses.pop(0)
+        items = []
+        for line in body.splitlines():
+            line = json.loads(line)
+            action_type = next(iter(line))
+            if action_type not in ("index", "update", "delete"):
+                continue
+            value = {
+                "_index": line[action_type]["_index"],
+                "_id": line[action_type]["_id"],
+                "status": statuses.pop(0),
+            }
+            if value["status"] >= 300:
+                value["error"] = {"type": "error"}
+            items.append({action_type: value})
+        return {"took": 1, "errors": False, "items": items}
+
+
+async def test_bulk_insert_retries_only_rejected_items(monkeypatch):
+    monkeypatch.setattr("guillotina_elasticsearch.utility.BULK_RETRY_INTERVAL", 0)
+    conn = FakeBulkConnection([[201, 429, 409, 404, 400], [201, 200, 201]])
+    utility = ElasticSearchUtility()
+    monkeypatch.setattr(utility, "get_connection", lambda purpose=None: conn)
+    result = await utility.bulk_insert(
+        [
+            {"index": {"_index": "foo", "_id": "a"}},
+            {"title": "a"},
+            {"index": {"_index": "foo", "_id": "b"}},
+            {"title": "b"},
+            {"update": {"_index": "foo", "_id": "c", "retry_on_conflict": 3}},
+            {"doc": {"title": "c"}},
+            {"update": {"_index": "foo", "_id": "d", "retry_on_conflict": 3}},
+            {"doc": {"title": "d"}},
+            {"index": {"_index": "foo", "_id": "e"}},
+            {"title": "e"},
+        ],
+        ["a", "b", "c", "d", "e"],
+    )
+    assert [json.loads(line) for line in conn.bodies[1].splitlines()] == [
+        {"index": {"_index": "foo", "_id": "b"}},
+        {"title": "b"},
+        {"update": {"_index": "foo", "_id": "c", "retry_on_conflict": 3}},
+        {"doc": {"title": "c"}},
+        {"index": {"_index": "foo", "_id": "d"}},
+        {"title": "d"},
+    ]
+    assert [next(iter(item.values()))["_id"] for item in result["items"]] == [
+        "a",
+        "b",
+        "c",
+        "d",
+        "e",
+    ]
+    assert result["retried"] == 3
+    assert result["errors"] is True
+    assert result["failed"] == [
+        {"_id": "e", "_index": "foo", "status": 400, "error": {"type": "error"}}
+    ]
+
+
+def test_bulk_serializer_encodes_ndjson():
+    operation = bulk_serializer.update("foo", "a", {"title": "á"})
+    lines = operation.payload.splitlines()
+    assert operation.payload.endswith(b"\n")
+    assert json.loads(lines[0]) == {
+        "update": {"_index": "foo", "retry_on_conflict": 3, "_id": "a"}
+    }
+    assert json.loads(lines[1]) == {"doc": {"title": "á"}}
+    assert bulk_serializer.delete("foo", "a").payload == (
+        b'{"delete":{"_index":"foo","_id":"a"}}\n'
+    )
+    # same output than the list of dicts format
+    assert (
+        bulk_serializer.from_lines(
+            [{"index": {"_index": "foo", "_id": "a"}}, {"title": "a"}]
+        )[0].payload
+        == bulk_serializer.index("foo", "a", {"title": "a"}).payload
+    )
+
+
+async def test_write_documents_defers_next_index_writes(monkeypatch):
+    utility = ElasticSearchUtility()
+    sent = []
+
+    async def bulk_insert(operations, idents, count=0, response=None):
+        sent.append(operations)
+        return {"took": 1, "errors": False, "items": []}
+
+    monkeypatch.setattr(utility, "bulk_insert", bulk_insert)
+    monkeypatch.setattr(ElasticSearchUtility, "bulk_size", 50)
+    monkeypatch.setattr(ElasticSearchUtility, "bulk_max_bytes", None)
+    monkeypatch.setattr(ElasticSearchUtility, "defer_migration_writes", True)
+
+    await utility._write_documents(
+        ["alias", "next"],
+        {"a": {"title": "a"}, "b": {"title": "b"}},
+        bulk_serializer.index,
+    )
+    await utility.join_deferred_writes()
+    assert len(sent) == 2
+    batches = sorted([[(op.index, op.id) for op in operations] for operations in sent])
+    assert batches == [[("alias", "a"), ("alias", "b")], [("next", "a"), ("next", "b")]]
+    # the document is only serialized once for both indexes
+    sources = {op.payload.split(b"\n")[1] for operations in sent for op in operations}
+    assert sources == {b'{"title":"a"}', b'{"title":"b"}'}
+
+
+async def test_deferred_writes_are_bounded_and_retried(monkeypatch):
+    utility = ElasticSearchUtility()
+    sent = []
+    released = asyncio.Event()
+    failures = {"b": [503], "c": [400]}
+
+    async def bulk_insert(operations, idents, count=0, response=None):
+        if operations[0].index == "next":
+            # next index writes are slow
+            await released.wait()
+        sent.append([(op.index, op.id) for op in operations])
+        failed = []
+        for op in operations:
+            if op.index == "next" and failures.get(op.id):
+                status = failures[op.id].pop()
+                failed.append({"_id": op.id, "_index": op.index, "status": status})
+        return {"took": 1, "errors": bool(failed), "items": [], "failed": failed}
+
+    monkeypatch.setattr(utility, "bulk_insert", bulk_insert)
+    monkeypatch.setattr(ElasticSearchUtility, "bulk_size", 50)
+    monkeypatch.setattr(ElasticSearchUtility, "bulk_max_bytes", None)
+    monkeypatch.setattr(ElasticSearchUtility, "defer_migration_writes", True)
+    monkeypatch.setattr(ElasticSearchUtility, "deferred_writes_max_pending", 2)
+    monkeypatch.setattr("guillotina_elasticsearch.utility.BULK_RETRY_INTERVAL", 0)
+
+    asyncio.get_running_loop().call_later(0.05, released.set)
+    for ident in ("a", "b", "c", "d"):
+        await utility._write_documents(
+            ["alias", "next"], {ident: {"title": ident}}, bulk_serializer.index
+        )
+        assert utility._deferred_pending <= 2
+    # the third write waited for the pending ones
+    assert released.is_set()
+
+    await utility.join_deferred_writes()
+    # unavailable errors are retried, the rest are counted
+    assert [batch for batch in sent if batch[0][0] == "next"] == [
+        [("next", "a")],
+        [("next", "b")],
+        [("next", "b")],
+        [("next", "c")],
+        [("next", "d")],
+    ]
+    assert utility.deferred_write_failures == 1
+
+
+class FakeDeleteConnection:
+    def __init__(self):
+        self.calls = []
+
+    async def delete_by_query(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("wait_for_completion") is False:
+            return {"task": f"node:{len(self.calls)}"}
+        return {"deleted": 1, "version_conflicts": 0}
+
+
+class FakeResource:
+    def __init__(self, path):
+        self.path = path
+
+
+async def test_unindex_children_groups_paths(monkeypatch):
+    conn = FakeDeleteConnection()
+    utility = ElasticSearchUtility()
+    monkeypatch.setattr(utility, "get_connection", lambda: conn)
+    monkeypatch.setattr(ElasticSearchUtility, "delete_children_chunk_size", 2)
+    monkeypatch.setattr(
+        "guillotina_elasticsearch.utility.get_content_path",
+        lambda resource: resource.path,
+    )
+    resources = [FakeResource(path) for path in ("/a", "/a/b", "/c", "/d/e")]
+    await utility.unindex_children(None, resources, index_name="foo")
+
+    assert len(conn.calls) == 2
+    query = conn.calls[0]["body"]["query"]["bool"]
+    assert query["minimum_should_match"] == 1
+    assert [
+        clause["bool"]["must"][0]["term"]["path"] for clause in query["should"]
+    ] == [
+        "/a",
+        "/c",
+    ]
+    assert conn.calls[1]["body"]["query"]["bool"]["must"] == [
+        {"term": {"path": "/d/e"}},
+        {"range": {"depth": {"gte": 3}}},
+    ]
+
+    monkeypatch.setattr(
+        ElasticSearchUtility, "delete_children_wait_for_completion", False
+    )
+    await utility.unindex_children(None, resources, index_name="foo")
+    assert conn.calls[-1]["wait_for_completion"] is False
+    assert utility._delete_tasks == ["node:3", "node:4"]
@@ -0,0 +1,119 @@
+from guillotina_elasticsearch.cache import SearchResultCache
+from guillotina_elasticsearch.indexing import IndexingQueue
+from guillotina_elasticsearch.tests.utils import FakeSearchConnection
+from guillotina_elasticsearch.tests.utils import patch_search_raw
+from guillotina_elasticsearch.utility import ElasticSearchUtility
+
+import time
+
+
+class FakeContainer:
+    def __init__(self, uuid):
+        self.__uuid__ = uuid
+
+
+def test_search_cache_get_set_and_expire(monkeypatch):
+    cache = SearchResultCache(size=10, ttl=5)
+    container = FakeContainer("container-1")
+    key = cache.get_key(container, "index", '{"query": {}}')
+    assert cache.get(key) is None
+    cache.set(key, {"items": [{"title": "a"}]})
+    result = cache.get(key)
+    assert result == {"items": [{"title": "a"}]}
+    # callers get copies
+    result["items"].append({"title": "b"})
+    assert cache.get(key) == {"items": [{"title": "a"}]}
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 10)
+    assert cache.get(key) is None
+    assert len(cache) == 0
+
+
+def test_search_cache_invalidate_container():
+    cache = SearchResultCache(size=10, ttl=5)
+    container = FakeContainer("container-1")
+    other = FakeContainer("container-2")
+    key = cache.get_key(container, "index", "query")
+    other_key = cache.get_key(other, "index", "query")
+    cache.set(key, {"items": []})
+    cache.set(other_key, {"items": []})
+
+    cache.invalidate(container)
+    assert cache.get(cache.get_key(container, "index", "query")) is None
+    assert cache.get(cache.get_key(other, "index", "query")) == {"items": []}
+
+    cache.invalidate()
+    assert cache.get(other_key) is None
+
+
+async def test_search_raw_uses_cache(monkeypatch):
+    utility = ElasticSearchUtility()
+    utility.search_cache = SearchResultCache()
+    conn = FakeSearchConnection()
+    container = FakeContainer("container-1")
+    patch_search_raw(monkeypatch, utility, conn, container)
+
+    container.roles = ["Reader"]
+    query = {"query": {"match_all": {}}}
+    first = await utility.search_raw(container, query, request=object())
+    second = await utility.search_raw(container, query, request=object())
+    assert (
+        first
+        == second
+        == {
+            "items_total": 1,
+            "items_total_relation": "eq",
+            "items": [],
+        }
+    )
+    assert len(conn.searches) == 1
+
+    # different security filter
+    container.roles = ["Manager"]
+    await utility.search_raw(container, query, request=object())
+    assert len(conn.searches) == 2
+
+    utility.invalidate_search_cache(container)
+    await utility.search_raw(container, query, request=object())
+    assert len(conn.searches) == 3
+
+    await utility.search_raw(container, query, request=object(), scroll="1m")
+    await utility.search_raw(container, query, request=object(), scroll="1m")
+    assert len(conn.searches) == 5
+
+
+async def test_search_cache_invalidated_after_writes(monkeypatch):
+    utility = ElasticSearchUtility()
+    utility.search_cache = SearchResultCache()
+    conn = FakeSearchConnection()
+    container = FakeContainer("container-1")
+    patch_search_raw(monkeypatch, utility, conn, container)
+    query = {"query": {"match_all": {}}}
+
+    async def get_current_indexes(container):
+        return ["index"]
+
+    async def write_documents(indexes, datas, build_operation, *args):
+        # a search running while the write is sent caches stale results
+        await utility.search_raw(container, query, request=object())
+
+    monkeypatch.setattr(utility, "get_current_indexes", get_current_indexes)
+    monkeypatch.setattr(utility, "_write_documents", write_documents)
+    monkeypatch.setattr(ElasticSearchUtility, "enabled", True)
+
+    await utility.index(container, {"a": {"title": "a"}})
+    assert len(conn.searches) == 1
+    await utility.search_raw(container, query, request=object())
+    assert len(conn.searches) == 2
+
+    # queued writes invalidate the cache once they are sent
+    utility.indexing_queue = IndexingQueue(utility, wait=10)
+    await utility.update(container, {"a": {"title": "b"}})
+    # searching between the write and the flush gets the cached results
+    await utility.search_raw(container, query, request=object())
+    assert len(conn.searches) == 2
+    await utility.indexing_queue.join()
+    await utility.search_raw(container, query, request=object())
+    assert len(conn.searches) == 3
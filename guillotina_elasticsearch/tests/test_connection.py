@@ -1,7 +1,15 @@
+from elastic_transport import AiohttpHttpNode
+from elastic_transport import NodeConfig
 from elasticsearch import AsyncElasticsearch as BaseAsyncElasticsearch
+from guillotina import app_settings
 from guillotina_elasticsearch.connection import apply_compatibility_headers
 from guillotina_elasticsearch.connection import AsyncElasticsearch
 from guillotina_elasticsearch.connection import get_connection_settings
+from guillotina_elasticsearch.connection import get_keepalive_node_class
+from guillotina_elasticsearch.connection import KeepAliveAiohttpHttpNode
+from guillotina_elasticsearch.utility import DefaultConnnectionFactoryUtility
+
+import aiohttp
 
 
 def test_apply_compatibility_headers_defaults():
@@ -106,3 +114,80 @@ async def test_perform_request_applies_compatibility_headers(monkeypatch):
             },
         )
     ]
+
+
+def test_get_connection_settings_overrides_and_keepalive():
+    settings = {"hosts": ["http://localhost:9200"], "connections_per_node": 10}
+
+    connection_settings = get_connection_settings(
+        settings,
+        {"hosts": ["http://ingest:9200"], "keepalive_timeout": 30},
+    )
+
+    assert connection_settings["hosts"] == ["http://ingest:9200"]
+    assert connection_settings["connections_per_node"] == 10
+    assert "keepalive_timeout" not in connection_settings
+    assert issubclass(connection_settings["node_class"], KeepAliveAiohttpHttpNode)
+    assert connection_settings["node_class"].keepalive_timeout == 30
+    assert "node_class" not in get_connection_settings(settings)
+
+
+async def test_keepalive_node_session():
+    node_class = get_keepalive_node_class(30)
+    node = node_class(NodeConfig("http", "localhost", 9200, connections_per_node=5))
+    node._create_aiohttp_session()
+    try:
+        assert node.session.connector.limit_per_host == 5
+        assert node.session.connector._keepalive_timeout == 30
+    finally:
+        await node.session.close()
+
+
+async def test_keepalive_node_session_matches_transport(monkeypatch):
+    # the session is copied from elastic_transport, fail if upstream changes it
+    calls = []
+
+    def record(name):
+        def factory(*args, **kwargs):
+            calls.append((name, args, kwargs))
+            return name
+
+        return factory
+
+    monkeypatch.setattr(aiohttp, "ClientSession", record("session"))
+    monkeypatch.setattr(aiohttp, "TCPConnector", record("connector"))
+    monkeypatch.setattr(aiohttp, "DummyCookieJar", record("cookie_jar"))
+
+    config = NodeConfig("http", "localhost", 9200, connections_per_node=5)
+    AiohttpHttpNode(config)._create_aiohttp_session()
+    expected = calls[:]
+    calls.clear()
+    get_keepalive_node_class(30)(config)._create_aiohttp_session()
+
+    assert calls[0] == ("cookie_jar", (), {})
+    name, args, kwargs = calls[1]
+    assert kwargs.pop("keepalive_timeout") == 30
+    assert calls == expected
+
+
+async def test_connection_factory_routes_by_purpose(monkeypatch):
+    monkeypatch.setitem(
+        app_settings,
+        "elasticsearch",
+        {
+            "connection_settings": {"hosts": ["http://localhost:9200"]},
+            "bulk_connection_settings": {"hosts": ["http://ingest:9200"]},
+        },
+    )
+    factory = DefaultConnnectionFactoryUtility()
+    try:
+        default = factory.get()
+        assert factory.get(purpose="search") is default
+        bulk = factory.get(purpose="bulk")
+        assert bulk is not default
+        assert factory.get(purpose="bulk") is bulk
+        assert [node.host for node in bulk.transport.node_pool.all()] == ["ingest"]
+    finally:
+        await factory.close()
+    assert factory._conn is None
+    assert factory._purpose_conns == {}
@@ -0,0 +1,196 @@
+from guillotina_elasticsearch.indexing import coalesce
+from guillotina_elasticsearch.indexing import IndexingQueue
+from guillotina_elasticsearch.utility import ElasticSearchUtility
+
+import asyncio
+
+
+class FakeUtility:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.sent = []
+
+    async def _write_documents(self, indexes, datas, build_operation):
+        await asyncio.sleep(self.delay)
+        self.sent.append((indexes, build_operation.__name__, datas))
+
+    async def _delete_documents(self, indexes, idents):
+        await asyncio.sleep(self.delay)
+        self.sent.append((indexes, "delete", idents))
+
+
+def test_coalesce():
+    assert coalesce(None, "update", {"a": 1}) == ("update", {"a": 1})
+    assert coalesce(("index", {"a": 1, "b": 1}), "update", {"a": 2}) == (
+        "index",
+        {"a": 2, "b": 1},
+    )
+    assert coalesce(("update", {"a": 1}), "update", {"b": 2}) == (
+        "update",
+        {"a": 1, "b": 2},
+    )
+    assert coalesce(("update", {"a": 1}), "delete", None) == ("delete", None)
+    assert coalesce(("delete", None), "update", {"a": 1}) == ("index", {"a": 1})
+    assert coalesce(("update", {"a": 1}), "index", {"b": 1}) == ("index", {"b": 1})
+
+
+def test_coalesce_merges_nested_objects():
+    current = ("index", {"title": "a", "meta": {"a": 1, "nested": {"x": 1}}})
+    assert coalesce(current, "update", {"meta": {"b": 2, "nested": {"y": 2}}}) == (
+        "index",
+        {"title": "a", "meta": {"a": 1, "b": 2, "nested": {"x": 1, "y": 2}}},
+    )
+    # other values, lists included, are replaced
+    assert coalesce(
+        ("update", {"meta": {"a": 1}, "tags": ["a"]}),
+        "update",
+        {"meta": "foo", "tags": ["b"]},
+    ) == ("update", {"meta": "foo", "tags": ["b"]})
+    # a newer pending update still wins over an older one
+    assert coalesce(
+        ("update", {"tid": 2, "meta": {"a": 2}}),
+        "update",
+        {"tid": 1, "meta": {"a": 1, "b": 1}},
+    ) == ("update", {"tid": 2, "meta": {"a": 2, "b": 1}})
+
+
+async def test_queue_coalesces_and_batches_writes():
+    utility = FakeUtility()
+    queue = IndexingQueue(utility, wait=0.05)
+    queue.start()
+    await queue.put(["foo"], "index", {"a": {"title": "a"}})
+    await queue.put(["foo"], "update", {"a": {"title": "a2"}, "b": {"title": "b"}})
+    await queue.put(["foo"], "index", {"c": {"title": "c"}})
+    await queue.put(["foo"], "delete", {"d": None})
+    assert len(queue) == 4
+    await asyncio.sleep(0.1)
+    assert len(queue) == 0
+    assert utility.sent == [
+        (("foo",), "index", {"a": {"title": "a2"}, "c": {"title": "c"}}),
+        (("foo",), "update", {"b": {"title": "b"}}),
+        (("foo",), "delete", ["d"]),
+    ]
+    await queue.close()
+
+
+async def test_queue_applies_backpressure():
+    utility = FakeUtility(delay=0.01)
+    queue = IndexingQueue(utility, max_size=2, wait=0)
+    queue.start()
+    for idx in range(6):
+        await queue.put(["foo"], "index", {f"doc{idx}": {}})
+        assert len(queue) <= 2
+    await queue.close()
+    sent = [ident for _, _, datas in utility.sent for ident in datas]
+    assert sent == [f"doc{idx}" for idx in range(6)]
+
+
+async def test_queue_close_drains_pending_writes():
+    utility = FakeUtility()
+    queue = IndexingQueue(utility, wait=10)
+    queue.start()
+    await queue.put(["foo", "next"], "update", {"a": {"title": "a"}})
+    await queue.close()
+    assert utility.sent == [(("foo", "next"), "update", {"a": {"title": "a"}})]
+
+
+class FailingUtility(FakeUtility):
+    def __init__(self, errors=0, failed=()):
+        super().__init__()
+        self.errors = errors
+        self.failed = failed
+
+    async def _write_documents(self, indexes, datas, build_operation):
+        if self.errors > 0:
+            self.errors -= 1
+            raise ConnectionError("elasticsearch is down")
+        await super()._write_documents(indexes, datas, build_operation)
+        return {
+            "failed": [
+                {"_id": ident, "_index": indexes[0], "status": 400}
+                for ident in datas
+                if ident in self.failed
+            ]
+        }
+
+
+async def test_queue_retries_failed_writes():
+    utility = FailingUtility(errors=1)
+    queue = IndexingQueue(utility, wait=10, retry_wait=0)
+    await queue.put(["foo"], "index", {"a": {"title": "a", "meta": {"x": 1}}})
+    # writes queued while the failed ones are sent again apply on top of them
+    send = queue._send
+
+    async def send_and_update(pending, cache_keys=()):
+        queue._send = send
+        await queue.put(["foo"], "update", {"a": {"meta": {"y": 2}}})
+        return await send(pending, cache_keys)
+
+    queue._send = send_and_update
+    await queue.join()
+    assert utility.sent == [
+        (("foo",), "index", {"a": {"title": "a", "meta": {"x": 1, "y": 2}}})
+    ]
+    assert queue.failed == 0
+    assert queue._attempts == {}
+
+
+async def test_queue_drops_writes_after_max_attempts():
+    utility = FailingUtility(failed=["b"])
+    queue = IndexingQueue(utility, wait=10, max_attempts=3, retry_wait=0)
+    await queue.put(["foo"], "index", {"a": {"title": "a"}, "b": {"title": "b"}})
+    await queue.join()
+    assert [datas for _, _, datas in utility.sent] == [
+        {"a": {"title": "a"}, "b": {"title": "b"}},
+        {"b": {"title": "b"}},
+        {"b": {"title": "b"}},
+    ]
+    assert queue.failed == 1
+    assert len(queue) == 0
+
+
+def test_coalesce_keeps_highest_tid():
+    assert coalesce(
+        ("update", {"title": "new", "tid": 5}),
+        "update",
+        {"title": "old", "a": 1, "tid": 4},
+    ) == ("update", {"title": "new", "a": 1, "tid": 5})
+    assert coalesce(
+        ("update", {"title": "new", "tid": 5}), "index", {"title": "old", "tid": 4}
+    ) == ("index", {"title": "new", "tid": 5})
+    assert coalesce(
+        ("index", {"title": "new", "tid": 5}), "update", {"title": "old", "tid": 4}
+    ) == ("index", {"title": "new", "tid": 5})
+    assert coalesce(
+        ("update", {"title": "old", "tid": 4}), "update", {"title": "new", "tid": 5}
+    ) == ("update", {"title": "new", "tid": 5})
+
+
+async def test_utility_coalesces_updates_within_window(monkeypatch):
+    utility = ElasticSearchUtility()
+    sent = []
+
+    async def write_documents(indexes, datas, build_operation, *args):
+        sent.append((build_operation.__name__, dict(datas)))
+
+    async def get_current_indexes(container):
+        return ["foo"]
+
+    monkeypatch.setattr(utility, "_write_documents", write_documents)
+    monkeypatch.setattr(utility, "get_current_indexes", get_current_indexes)
+    monkeypatch.setattr(ElasticSearchUtility, "enabled", True)
+    utility.update_queue = IndexingQueue(utility, wait=10)
+    utility.update_queue.start()
+
+    await utility.update(None, {"a": {"counter": 1, "tid": 1}})
+    await utility.update(None, {"a": {"counter": 3, "tid": 3}})
+    await utility.update(None, {"a": {"counter": 2, "tid": 2}})
+    assert sent == []
+    # index flushes pending updates first
+    await utility.index(None, {"b": {"title": "b"}})
+    assert sent == [
+        ("update", {"a": {"counter": 3, "tid": 3}}),
+        ("index", {"b": {"title": "b"}}),
+    ]
+    assert utility.update_queue.coalesced == 2
+    await utility.update_queue.close()
@@ -18,6 +18,7 @@ from guillotina_elasticsearch.tests.utils import setup_txn_on_container
 import asyncio
 import elasticsearch
 import json
+import os
 import pytest
 import random
 
@@ -73,7 +74,10 @@ async def test_migrate_get_all_uids(es_requester):
         migrator = Migrator(search, container, force=True)
         uids = await migrator.get_all_uids()
 
+        assert isinstance(uids, set)
         assert len(uids) == current_count
+        migrator.existing = uids
+        assert migrator.get_uids_memory() > len(uids) * 32
 
         await tm.abort(txn=txn)
 
@@ -107,6 +111,104 @@ async def test_removes_orphans(es_requester):
         await run_with_retries(_test, requester)
 
 
+async def test_removes_orphans_with_uids_db(es_requester, tmp_path):
+    async with es_requester as requester:
+        container, request, txn, tm = await setup_txn_on_container(requester)
+        search = get_utility(ICatalogUtility)
+        await search.index(
+            container, {"foobar": {"title": "foobar", "type_name": "Item"}}
+        )
+        im = get_adapter(container, IIndexManager)
+        index_name = await im.get_index_name()  # alias
+
+        uids_db = str(tmp_path / "uids.db")
+        migrator = Migrator(search, container, force=True, uids_db=uids_db)
+        await migrator.run_migration()
+        assert migrator.status == "done"
+        assert len(migrator.orphaned) == 1
+        # the file is removed once the migration is done
+        assert not os.path.exists(uids_db)
+
+        async def _test():
+            with pytest.raises(elasticsearch.exceptions.NotFoundError):
+                await search.get_connection().get(index=index_name, id="foobar")
+
+        await run_with_retries(_test, requester)
+
+
+async def test_resume_migration(es_requester, tmp_path):
+    async with es_requester as requester:
+        await add_content(requester, 2, 2)
+        container, request, txn, tm = await setup_txn_on_container(requester)
+        search = get_utility(ICatalogUtility)
+        await asyncio.sleep(1)
+        await search.refresh(container)
+        await asyncio.sleep(1)
+        original_count = await search.get_doc_count(container)
+
+        # the migration dies once the next index is created
+        uids_db = str(tmp_path / "uids.db")
+        migrator = Migrator(search, container, force=True, full=True, uids_db=uids_db)
+        await migrator.setup_next_index()
+        await migrator.checkpoint(uids_loaded=False)
+        migrator.uids_store.close()
+
+        migrator = Migrator(search, container, full=True, uids_db=uids_db, resume=True)
+        await migrator.run_migration()
+        assert migrator.status == "done"
+        assert not os.path.exists(uids_db)
+
+        await asyncio.sleep(1)
+        await search.refresh(container)
+        await asyncio.sleep(1)
+        num_docs = await search.get_doc_count(container, migrator.work_index_name)
+        assert num_docs == original_count
+
+        with pytest.raises(Exception):
+            Migrator(search, container, resume=True)
+
+
+async def test_resume_migration_mid_crawl(es_requester, tmp_path):
+    async with es_requester as requester:
+        await add_content(requester, 3, 2)
+        container, request, txn, tm = await setup_txn_on_container(requester)
+        search = get_utility(ICatalogUtility)
+        await asyncio.sleep(1)
+        await search.refresh(container)
+        await asyncio.sleep(1)
+        original_count = await search.get_doc_count(container)
+
+        # the migration dies while crawling the second folder
+        uids_db = str(tmp_path / "uids.db")
+        migrator = Migrator(search, container, force=True, full=True, uids_db=uids_db)
+        process_children = migrator.process_children
+
+        async def process_children_and_die(ob):
+            if ob.id == "es-folder1":
+                await migrator.checkpoint()
+                raise RuntimeError("migration died")
+            await process_children(ob)
+
+        migrator.process_children = process_children_and_die
+        with pytest.raises(RuntimeError):
+            await migrator.run_migration()
+        checkpoint = migrator.uids_store.get_checkpoint()
+        assert len(checkpoint["frontier"]) > 0
+        assert checkpoint["processed"] > 0
+        migrator.uids_store.close()
+
+        migrator = Migrator(search, container, full=True, uids_db=uids_db, resume=True)
+        await migrator.run_migration()
+        assert migrator.status == "done"
+        assert migrator.errors == []
+
+        await asyncio.sleep(1)
+        await search.refresh(container)
+        await asyncio.sleep(1)
+        num_docs = await search.get_doc_count(container, migrator.work_index_name)
+        assert num_docs == original_count
+
+
 async def test_fixes_missing(es_requester):
     async with es_requester as requester:
         await add_content(requester, 2, 2)
@@ -150,6 +252,39 @@ async def test_fixes_missing(es_requester):
         assert old_index_name != await im.get_real_index_name()
 
 
+async def test_migrate_with_workers(es_requester):
+    async with es_requester as requester:
+        await add_content(requester, 3, 3)
+        container, request, txn, tm = await setup_txn_on_container(requester)
+
+        search = get_utility(ICatalogUtility)
+        await asyncio.sleep(1)
+        await search.refresh(container)
+        await asyncio.sleep(1)
+        original_count = await search.get_doc_count(container)
+
+        # folders are nested, unindex a leaf item so only it is missing
+        folder = await container.async_get("es-folder0")
+        keys = [key for key in await folder.async_keys() if key != "es-folder1"]
+        ob = await folder.async_get(random.choice(keys))
+        await search.remove(container, [(ob)], request=request)
+        await asyncio.sleep(1)
+        await search.refresh(container)
+        await asyncio.sleep(1)
+
+        migrator = Migrator(search, container, force=True, workers=4, load_batch_size=2)
+        await migrator.run_migration()
+        assert migrator.status == "done"
+        assert set(migrator.missing) == {ob.uuid}
+        assert migrator.errors == []
+
+        await asyncio.sleep(1)
+        await search.refresh(container)
+        await asyncio.sleep(1)
+        num_docs = await search.get_doc_count(container, migrator.work_index_name)
+        assert num_docs == original_count
+
+
 async def test_updates_index_data(es_requester):
     async with es_requester as requester:
         container, request, txn, tm = await setup_txn_on_container(requester)
@@ -1,8 +1,13 @@
 from guillotina.directives import index_field
 from guillotina.interfaces import IContainer
 from guillotina.tests import utils as test_utils
+from guillotina_elasticsearch import parser as parser_module
+from guillotina_elasticsearch.parser import get_field_descriptor
+from guillotina_elasticsearch.parser import invalidate_parse_cache
 from guillotina_elasticsearch.parser import Parser
+from guillotina_elasticsearch.parser import process_field
 from guillotina_elasticsearch.tests.utils import setup_txn_on_container
+from guillotina_elasticsearch.utils import encode_cursor
 
 import asyncio
 import json
@@ -20,7 +25,7 @@ async def test_boolean_field(es_requester):
         params = {"depth__gte": "1", "type_name": "IItem", "foo_bool": True}
         parser = Parser(None, container)
         query = parser(params)
-        qq = query["query"]["bool"]["must"]
+        qq = query["query"]["bool"]["filter"]
         assert "_from" not in query
         assert qq[1]["term"]["type_name"] == "IItem"
         # https://www.elastic.co/guide/en/elasticsearch/reference/current/boolean.html
@@ -48,8 +53,8 @@ async def test_es_field_date_parser(dummy_guillotina):
             "_sort_asc": "modification_date",
         }
     )
-    qq = parsed["query"]["bool"]["must"]
-    assert len(qq[-2]["bool"]["should"]) == 5
+    assert len(parsed["query"]["bool"]["must"][0]["bool"]["should"]) == 5
+    qq = parsed["query"]["bool"]["filter"]
 
     assert "range" in qq[0]
     assert "modification_date" in qq[0]["range"]
@@ -64,12 +69,12 @@ async def test_parser_term_and_terms(dummy_guillotina):
     parser = Parser(None, content)
     params = {"depth__gte": "2", "type_name": "Item"}
     query = parser(params)
-    qq = query["query"]["bool"]["must"]
+    qq = query["query"]["bool"]["filter"]
     assert "_from" not in query
     assert qq[1]["term"]["type_name"] == "Item"
     params = {"depth__gte": "2", "type_name": ["Item", "Folder"]}
     query = parser(params)
-    qq = query["query"]["bool"]["must"]
+    qq = query["query"]["bool"]["filter"]
     assert "Item" in qq[1]["terms"]["type_name"]
     assert "Folder" in qq[1]["terms"]["type_name"]
     # Check that b_start and b_size work as expected
@@ -80,6 +85,35 @@ async def test_parser_term_and_terms(dummy_guillotina):
     assert query["size"] == 10
 
 
+async def test_parser_track_total_hits(dummy_guillotina):
+    content = test_utils.create_content()
+    parser = Parser(None, content)
+    query = parser({"type_name": "Item"})
+    assert "track_total_hits" not in query
+    query = parser({"type_name": "Item", "_track_total_hits": "true"})
+    assert query["track_total_hits"] is True
+    query = parser({"type_name": "Item", "_track_total_hits": "50000"})
+    assert query["track_total_hits"] == 50000
+
+
+async def test_parser_search_after(dummy_guillotina):
+    content = test_utils.create_content()
+    parser = Parser(None, content)
+    query = parser({"type_name": "Item", "_pit": "true"})
+    assert query["pit"] == {"keep_alive": "1m"}
+    assert "search_after" not in query
+
+    cursor = encode_cursor(["2020", "uuid"], "pitid", "5m")
+    query = parser({"type_name": "Item", "_cursor": cursor, "b_start": 40})
+    assert query["search_after"] == ["2020", "uuid"]
+    assert query["pit"] == {"id": "pitid", "keep_alive": "5m"}
+    assert "from" not in query
+
+    query = parser({"type_name": "Item", "_cursor": encode_cursor(["2020"])})
+    assert query["search_after"] == ["2020"]
+    assert "pit" not in query
+
+
 async def test_parser_or_clause_with_not_null_uses_should(dummy_guillotina):
     content = test_utils.create_content()
     parser = Parser(None, content)
@@ -87,7 +121,7 @@ async def test_parser_or_clause_with_not_null_uses_should(dummy_guillotina):
     bool_query = query["query"]["bool"]
     or_clause = next(
         item["bool"]
-        for item in bool_query["must"]
+        for item in bool_query["filter"]
         if isinstance(item, dict)
         and "bool" in item
         and item["bool"].get("minimum_should_match") == 1
@@ -106,7 +140,7 @@ async def test_parser_or_clause_ignores_unknown_fields(dummy_guillotina):
     bool_query = query["query"]["bool"]
     or_clause = next(
         item["bool"]
-        for item in bool_query["must"]
+        for item in bool_query["filter"]
         if isinstance(item, dict)
         and "bool" in item
         and item["bool"].get("minimum_should_match") == 1
@@ -171,9 +205,6 @@ async def test_es_multi_match_parser(dummy_guillotina):
         "query": {
             "bool": {
                 "must": [
-                    {"term": {"type_name": "FooContent"}},
-                    {"range": {"depth": {"gte": 1}}},
-                    {"wildcard": {"path": "/*"}},
                     {
                         "multi_match": {
                             "fields": ["item_text^2", "item_text_2^3"],
@@ -184,6 +215,11 @@ async def test_es_multi_match_parser(dummy_guillotina):
                         }
                     },
                 ],
+                "filter": [
+                    {"term": {"type_name": "FooContent"}},
+                    {"range": {"depth": {"gte": 1}}},
+                    {"wildcard": {"path": "/*"}},
+                ],
                 "must_not": [],
             }
         },
@@ -203,4 +239,106 @@ async def test_es_multi_match_parser(dummy_guillotina):
             "uuid",
             "*",
         ],
+        "_source": False,
     }
+
+
+async def test_parser_source_filtering(dummy_guillotina):
+    content = test_utils.create_content()
+    parser = Parser(None, content)
+
+    query = parser({"_metadata": "title,depth"})
+    assert query["stored_fields"].count("title") == 1
+    assert "depth" not in query["stored_fields"]
+    assert query["_source"] == {"includes": ["depth"]}
+
+    # default searches only read stored fields
+    for params in ({}, {"_metadata": "_all"}):
+        query = parser(params)
+        assert "depth" not in query["stored_fields"]
+        assert query["_source"] is False
+
+    query = parser({"_metadata_not": "tags,creators"})
+    assert "tags" not in query["stored_fields"]
+    assert "creators" not in query["stored_fields"]
+    assert query["_source"] is False
+
+    query = parser({"_metadata": "uuid", "_metadata_only": "true"})
+    assert query["stored_fields"] == ["path", "uuid"]
+    assert query["_source"] is False
+
+
+async def test_parser_field_descriptors(dummy_guillotina):
+    invalidate_parse_cache()
+    assert get_field_descriptor("title__should") == (
+        "should",
+        "title",
+        None,
+        None,
+        "text",
+    )
+    assert get_field_descriptor("depth__gte%5E2") == (
+        "must",
+        "depth",
+        2.0,
+        "gte",
+        "int",
+    )
+    assert get_field_descriptor("foobar__in") is None
+    assert process_field("depth__gte%5E2", "3") == process_field("depth__gte%5E2", "3")
+    assert process_field("depth__gte%5E2", "3") == (
+        "must",
+        {"range": {"depth": {"gte": 3, "boost": 2.0}}},
+    )
+
+
+async def test_parser_caches_parsed_queries(dummy_guillotina):
+    invalidate_parse_cache()
+    content = test_utils.create_content()
+    parser = Parser(None, content)
+    query = parser({"type_name": "Item", "_sort_asc": "title"})
+    query["query"]["bool"]["must"].append({"term": {"foo": "bar"}})
+    cached = parser({"type_name": "Item", "_sort_asc": "title"})
+    assert cached is not query
+    assert {"term": {"foo": "bar"}} not in cached["query"]["bool"]["must"]
+    assert cached == parser.parse({"type_name": "Item", "_sort_asc": "title"})
+    assert len(parser_module._parse_cache) == 1
+    invalidate_parse_cache()
+    assert len(parser_module._parse_cache) == 0
+
+
+async def test_parser_filter_context(dummy_guillotina):
+    content = test_utils.create_content()
+    parser = Parser(None, content)
+    query = parser.parse(
+        {
+            "type_name": "Item",
+            "title__in": "foo",
+            "id^2": "foo",
+            "__and": "tags=foo%26tags__not=bar",
+        }
+    )
+    bool_query = query["query"]["bool"]
+    assert bool_query["must"] == [
+        {"match": {"title": "foo"}},
+        {"term": {"id": {"value": "foo", "boost": 2.0}}},
+    ]
+    assert bool_query["filter"][:2] == [
+        {"term": {"type_name": "Item"}},
+        {
+            "bool": {
+                "must": [],
+                "filter": [{"term": {"tags": "foo"}}],
+                "must_not": [{"term": {"tags": "bar"}}],
+            }
+        },
+    ]
+
+
+@pytest.mark.app_settings({"elasticsearch": {"filter_context": False}})
+async def test_parser_filter_context_disabled(dummy_guillotina):
+    content = test_utils.create_content()
+    parser = Parser(None, content)
+    query = parser.parse({"type_name": "Item"})
+    assert "filter" not in query["query"]["bool"]
+    assert query["query"]["bool"]["must"][0] == {"term": {"type_name": "Item"}}
@@ -0,0 +1,111 @@
+from guillotina_elasticsearch import queries
+from guillotina_elasticsearch.queries import build_security_query
+from guillotina_elasticsearch.queries import get_security_principals
+from guillotina_elasticsearch.queries import invalidate_security_query_cache
+from guillotina_elasticsearch.queries import principal_changed
+
+import time
+
+
+class FakeUser:
+    def __init__(self, id, groups, roles=None):
+        self.id = id
+        self.groups = groups
+        self.roles = roles or {}
+
+
+class FakePolicy:
+    def __init__(self):
+        self.calls = 0
+
+    def global_principal_roles(self, principal, groups):
+        self.calls += 1
+        return {"guillotina.Anonymous": True, "guillotina.Member": True, "no": False}
+
+
+def test_security_principals_are_cached():
+    invalidate_security_query_cache()
+    policy = FakePolicy()
+    user = FakeUser("user", ["group1", "group2"])
+    expected = (
+        ("guillotina.Anonymous", "guillotina.Member"),
+        ("user", "group1", "group2"),
+    )
+    assert get_security_principals(user, policy) == expected
+    assert get_security_principals(user, policy) == expected
+    assert policy.calls == 1
+
+    # different global roles or groups are different entries
+    get_security_principals(FakeUser("user", ["group1"]), policy)
+    get_security_principals(
+        FakeUser("user", ["group1", "group2"], {"guillotina.Editor": 1}), policy
+    )
+    assert policy.calls == 3
+
+    invalidate_security_query_cache()
+    get_security_principals(user, policy)
+    assert policy.calls == 4
+
+
+class GroupRolesPolicy:
+    def __init__(self, group_roles):
+        self.group_roles = group_roles
+
+    def global_principal_roles(self, principal, groups):
+        roles = {}
+        for group in groups:
+            roles.update(self.group_roles.get(group, {}))
+        return roles
+
+
+async def test_security_principals_follow_group_roles(monkeypatch):
+    invalidate_security_query_cache()
+    group_roles = {"group1": {"guillotina.Editor": True}}
+    policy = GroupRolesPolicy(group_roles)
+    user = FakeUser("user", ["group1"])
+    assert get_security_principals(user, policy)[0] == ("guillotina.Editor",)
+
+    # the group loses its role, cached entries expire
+    group_roles["group1"] = {}
+    assert get_security_principals(user, policy)[0] == ("guillotina.Editor",)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 10)
+    assert get_security_principals(user, policy)[0] == ()
+
+    # modifying a group clears them right away
+    group_roles["group1"] = {"guillotina.Editor": True}
+    assert get_security_principals(user, policy)[0] == ()
+    await principal_changed(object(), None)
+    assert get_security_principals(user, policy)[0] == ("guillotina.Editor",)
+
+
+async def test_build_security_query_uses_terms(monkeypatch):
+    invalidate_security_query_cache()
+    user = FakeUser("user", ["group1"])
+    monkeypatch.setattr(queries, "get_authenticated_user", lambda: user)
+    monkeypatch.setattr(queries, "get_security_policy", lambda user: FakePolicy())
+    query = await build_security_query(None)
+    assert query == {
+        "query": {
+            "bool": {
+                "filter": [
+                    {
+                        "bool": {
+                            "should": [
+                                {
+                                    "terms": {
+                                        "access_roles": [
+                                            "guillotina.Anonymous",
+                                            "guillotina.Member",
+                                        ]
+                                    }
+                                },
+                                {"terms": {"access_users": ["user", "group1"]}},
+                            ],
+                            "minimum_should_match": 1,
+                        }
+                    }
+                ]
+            }
+        }
+    }
@@ -1,17 +1,24 @@
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
+from guillotina import app_settings
 from guillotina.auth import authenticate_user
 from guillotina.auth import set_authenticated_user
 from guillotina.auth.utils import find_user
 from guillotina.component import get_utility
 from guillotina.interfaces import ICatalogUtility
 from guillotina.utils import get_authenticated_user
+from guillotina_elasticsearch.parser import parse_track_total_hits
 from guillotina_elasticsearch.parser import Parser
+from guillotina_elasticsearch.tests.utils import FakeSearchConnection
+from guillotina_elasticsearch.tests.utils import patch_search_raw
 from guillotina_elasticsearch.tests.utils import run_with_retries
 from guillotina_elasticsearch.tests.utils import setup_txn_on_container
+from guillotina_elasticsearch.utility import ElasticSearchUtility
+from guillotina_elasticsearch.utils import decode_cursor
 
 import asyncio
+import contextlib
 import json
 import pytest
 
@@ -733,3 +740,133 @@ async def test_search_boost(es_requester):
         score_2 = resp["items"][1]["sort"][0]
         assert score_1 > score_2
         assert resp["items"][0]["id"] == "item"
+
+
+def test_parse_track_total_hits():
+    assert parse_track_total_hits(None) is None
+    assert parse_track_total_hits("true") is True
+    assert parse_track_total_hits("false") is False
+    assert parse_track_total_hits("500") == 500
+    assert parse_track_total_hits(100) == 100
+    assert parse_track_total_hits("foo") is None
+
+
+class FakeContainer:
+    __uuid__ = "container"
+
+
+async def test_search_raw_total_relation(monkeypatch):
+    utility = ElasticSearchUtility()
+    conn = FakeSearchConnection(total={"value": 10000, "relation": "gte"}, count=12345)
+    patch_search_raw(monkeypatch, utility, conn, FakeContainer())
+
+    result = await utility.search_raw(FakeContainer(), {"query": {}})
+    assert result["items_total"] == 10000
+    assert result["items_total_relation"] == "gte"
+    assert conn.counts == []
+
+    result = await utility.search_raw(FakeContainer(), {"query": {}}, count_total=True)
+    assert result["items_total"] == 12345
+    assert result["items_total_relation"] == "eq"
+    assert len(conn.counts) == 1
+
+    conn.total = False
+    result = await utility.search_raw(
+        FakeContainer(), {"query": {}, "track_total_hits": False}
+    )
+    assert conn.searches[-1]["body"]["track_total_hits"] is False
+    assert result["items_total"] == 0
+    assert result["items_total_relation"] == "gte"
+
+
+async def test_search_raw_search_after_with_pit(monkeypatch):
+    monkeypatch.setitem(app_settings, "jwt", {"secret": "secret"})
+    utility = ElasticSearchUtility()
+    conn = FakeSearchConnection(
+        pages=[
+            [{"_id": "a", "sort": ["a"]}, {"_id": "b", "sort": ["b"]}],
+            [{"_id": "c", "sort": ["c"]}],
+        ]
+    )
+    patch_search_raw(monkeypatch, utility, conn, FakeContainer())
+
+    query = {"query": {}, "size": 2, "pit": {"keep_alive": "2m"}}
+    result = await utility.search_raw(FakeContainer(), query)
+    assert conn.open_pits == [("index", "2m")]
+    assert conn.searches[0]["index"] is None
+    assert "ignore_unavailable" not in conn.searches[0]
+    assert conn.searches[0]["body"]["pit"] == {"keep_alive": "2m", "id": "pit1"}
+    # the query is not modified
+    assert query["pit"] == {"keep_alive": "2m"}
+    cursor = decode_cursor(result["cursor"])
+    assert cursor == {"search_after": ["b"], "pit": "pit1", "keep_alive": "2m"}
+
+    query = {
+        "query": {},
+        "size": 2,
+        "search_after": cursor["search_after"],
+        "pit": {"id": cursor["pit"], "keep_alive": cursor["keep_alive"]},
+    }
+    result = await utility.search_raw(FakeContainer(), query)
+    assert len(conn.open_pits) == 1
+    assert conn.searches[1]["body"]["search_after"] == ["b"]
+    # last page
+    assert "cursor" not in result
+    assert conn.closed_pits == ["pit1"]
+
+
+async def test_search_raw_pit_without_secret(monkeypatch):
+    monkeypatch.setitem(app_settings, "jwt", {})
+    utility = ElasticSearchUtility()
+    conn = FakeSearchConnection(
+        pages=[[{"_id": "a", "sort": ["a"]}, {"_id": "b", "sort": ["b"]}]]
+    )
+    patch_search_raw(monkeypatch, utility, conn, FakeContainer())
+
+    query = {"query": {}, "size": 2, "pit": {"keep_alive": "2m"}}
+    result = await utility.search_raw(FakeContainer(), query)
+    # the cursor could be forged, none is returned
+    assert "cursor" not in result
+    assert conn.closed_pits == ["pit1"]
+
+
+async def test_iter_search_pages_on_point_in_time(monkeypatch):
+    utility = ElasticSearchUtility()
+    conn = FakeSearchConnection(
+        pages=[
+            [{"_id": "a", "sort": [0]}, {"_id": "b", "sort": [1]}],
+            [{"_id": "c", "sort": [2]}, {"_id": "d", "sort": [3]}],
+            [],
+        ]
+    )
+    patch_search_raw(monkeypatch, utility, conn, FakeContainer())
+    monkeypatch.setattr(
+        utility,
+        "_get_items_from_result",
+        lambda container, request, result, fields: [
+            {"@uid": hit["_id"]} for hit in result["hits"]["hits"]
+        ],
+    )
+
+    items = [
+        item["@uid"]
+        async for item in utility.iter_search(FakeContainer(), {}, page_size=2)
+    ]
+    assert items == ["a", "b", "c", "d"]
+    assert conn.open_pits == [("index", "1m")]
+    assert [search["body"].get("search_after") for search in conn.searches] == [
+        None,
+        [1],
+        [3],
+    ]
+    assert conn.searches[0]["body"]["sort"] == [{"_shard_doc": "asc"}]
+    assert conn.closed_pits == ["pit1"]
+
+    # stopping early closes the point in time too
+    conn.pages = [[{"_id": "a", "sort": [0]}, {"_id": "b", "sort": [1]}]]
+    async with contextlib.aclosing(
+        utility.iter_search(FakeContainer(), {}, page_size=2)
+    ) as results:
+        async for item in results:
+            break
+    assert conn.closed_pits == ["pit1", "pit2"]
@@ -0,0 +1,62 @@
+from guillotina_elasticsearch.uids import UidStore
+
+import os
+import pytest
+import sqlite3
+
+
+def test_disk_uid_set(tmp_path):
+    path = str(tmp_path / "uids.db")
+    store = UidStore(path)
+    existing = store.get_set("existing")
+    missing = store.get_set("missing")
+    existing.update(f"uid{idx}" for idx in range(2500))
+    existing.update(["uid1", "uid2"])
+    assert len(existing) == 2500
+    assert "uid10" in existing
+    assert "foobar" not in existing
+
+    # a failed update is rolled back
+    with pytest.raises(sqlite3.ProgrammingError):
+        existing.update(["uid5000", object()])
+    assert "uid5000" not in existing
+    assert len(existing) == 2500
+
+    existing.discard("uid10")
+    existing.discard("uid10")
+    assert "uid10" not in existing
+    assert len(existing) == 2499
+
+    missing.append("foobar")
+    missing.append("foobar")
+    assert len(missing) == 1
+    assert list(missing) == ["foobar"]
+
+    # iterated in pages, in insertion order
+    uids = list(existing)
+    assert len(uids) == 2499
+    assert uids[:3] == ["uid0", "uid1", "uid2"]
+    assert "uid10" not in uids
+
+    store.close()
+    store = UidStore(path)
+    assert len(store.get_set("existing", clear=False)) == 2499
+    assert len(store.get_set("missing")) == 0
+    store.close(remove=True)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + "-wal")
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / "uids.db")
+    store = UidStore(path)
+    assert store.get_checkpoint() is None
+    store.set_checkpoint({"frontier": None, "processed": 0})
+    store.set_checkpoint({"frontier": ["foo"], "processed": 10})
+    store.close()
+
+    store = UidStore(path)
+    assert store.get_checkpoint() == {"frontier": ["foo"], "processed": 10}
+    store.clear_checkpoint()
+    assert store.get_checkpoint() is None
+    store.close(remove=True)
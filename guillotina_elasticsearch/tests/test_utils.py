@@ -0,0 +1,139 @@
+from guillotina import app_settings
+from guillotina_elasticsearch.exceptions import InvalidCursorException
+from guillotina_elasticsearch.utils import _sign_cursor
+from guillotina_elasticsearch.utils import decode_cursor
+from guillotina_elasticsearch.utils import encode_cursor
+from guillotina_elasticsearch.utils import format_hit
+from guillotina_elasticsearch.utils import get_cached_indexes
+from guillotina_elasticsearch.utils import get_top_paths
+from guillotina_elasticsearch.utils import HitFormatter
+from guillotina_elasticsearch.utils import invalidate_hit_formatters
+from guillotina_elasticsearch.utils import invalidate_index_name_cache
+from guillotina_elasticsearch.utils import MultiValuedFieldRegistry
+from guillotina_elasticsearch.utils import set_cached_indexes
+
+import base64
+import json
+import pytest
+import time
+
+
+class FakeContainer:
+    def __init__(self, uuid):
+        self.__uuid__ = uuid
+
+
+def test_index_name_cache():
+    container = FakeContainer("container-1")
+    other = FakeContainer("container-2")
+    assert get_cached_indexes(container) is None
+
+    set_cached_indexes(container, ["alias", "alias_2"], 60)
+    set_cached_indexes(other, ["other"], 60)
+    assert get_cached_indexes(container) == ["alias", "alias_2"]
+
+    invalidate_index_name_cache(container)
+    assert get_cached_indexes(container) is None
+    assert get_cached_indexes(other) == ["other"]
+
+    invalidate_index_name_cache()
+    assert get_cached_indexes(other) is None
+
+
+def test_index_name_cache_expires(monkeypatch):
+    container = FakeContainer("container-1")
+    set_cached_indexes(container, ["alias"], 5)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 10)
+    assert get_cached_indexes(container) is None
+
+
+def test_get_top_paths():
+    assert get_top_paths(["/a/b", "/a", "/ab", "/c/d", "/a/b/c", "/c/d"]) == [
+        "/a",
+        "/ab",
+        "/c/d",
+    ]
+    assert get_top_paths(["/a", "/"]) == ["/"]
+    assert get_top_paths(["/a", "/a-b", "/a/b"]) == ["/a", "/a-b"]
+    assert get_top_paths(["/a-b/c", "/a/b", "/a", "/a-b"]) == ["/a", "/a-b"]
+
+
+def test_cursor(monkeypatch):
+    monkeypatch.setitem(app_settings, "jwt", {"secret": "secret"})
+    cursor = encode_cursor(["2020-01-01", "uuid"], "pitid", "1m")
+    assert decode_cursor(cursor) == {
+        "search_after": ["2020-01-01", "uuid"],
+        "pit": "pitid",
+        "keep_alive": "1m",
+    }
+    assert decode_cursor(encode_cursor([1])) == {"search_after": [1]}
+
+    payload, signature = cursor.split(".")
+    tampered = encode_cursor(["2020-01-01", "uuid"], "otherpit").split(".")[0]
+    for value in (tampered + "." + signature, payload, "foo", None):
+        with pytest.raises(InvalidCursorException):
+            decode_cursor(value)
+
+
+def test_cursor_without_secret(monkeypatch):
+    monkeypatch.setitem(app_settings, "jwt", {})
+    assert decode_cursor(encode_cursor([1])) == {"search_after": [1]}
+    with pytest.raises(ValueError):
+        encode_cursor([1], "pitid", "1m")
+
+    # a point in time cursor signed with the empty secret
+    data = json.dumps({"search_after": [1], "pit": "other"}).encode()
+    payload = base64.urlsafe_b64encode(data).decode().rstrip("=")
+    with pytest.raises(InvalidCursorException):
+        decode_cursor(f"{payload}.{_sign_cursor(payload, '')}")
+
+
+def test_format_hit_does_not_modify_hit(monkeypatch):
+    monkeypatch.setattr(
+        "guillotina_elasticsearch.utils._is_multi_valued",
+        lambda name: name == "tags",
+    )
+    hit = {
+        "_id": "uuid",
+        "_source": {"title": "foo", "obj": {"a": 1}},
+        "fields": {
+            "tags": ["one"],
+            "id": ["foo"],
+            "empty": [],
+            "obj.b": [2],
+            "other.c": ["x", "y"],
+        },
+    }
+    formatter = HitFormatter(["tags", "id", "obj.b"])
+    assert formatter(hit) == {
+        "title": "foo",
+        "tags": ["one"],
+        "id": "foo",
+        "empty": None,
+        "obj": {"a": 1, "b": 2},
+        "other": {"c": ["x", "y"]},
+    }
+    assert hit["_source"] == {"title": "foo", "obj": {"a": 1}}
+    invalidate_hit_formatters()
+    try:
+        assert format_hit(hit) == formatter(hit)
+    finally:
+        invalidate_hit_formatters()
+
+
+async def test_multi_valued_field_registry(dummy_guillotina):
+    registry = MultiValuedFieldRegistry()
+    fields = registry.build()
+    assert fields["creators"] is True
+    assert fields["title"] is False
+    assert registry.is_multi_valued("creators")
+    assert not registry.is_multi_valued("unknown")
+
+    inspected = registry.as_dict()
+    inspected["title"] = True
+    assert not registry.is_multi_valued("title")
+
+    registry.invalidate()
+    assert registry._fields is None
+    assert registry.is_multi_valued("creators")
@@ -8,6 +8,7 @@ from guillotina_elasticsearch.connection import AsyncElasticsearch
 from guillotina_elasticsearch.connection import get_connection_settings
 
 import asyncio
+import copy
 import elasticsearch.exceptions
 import json
 import time
@@ -114,3 +115,69 @@ async def cleanup_es(es_host, prefix=""):
                     pass
     finally:
         await conn.close()
+
+
+class FakeSearchConnection:
+    """
+    Records the searches and returns hits with the given total
+    """
+
+    def __init__(self, total=None, count=None, pages=None):
+        self.total = total or {"value": 1, "relation": "eq"}
+        self.count_result = count
+        self.pages = pages or []
+        self.searches = []
+        self.counts = []
+        self.open_pits = []
+        self.closed_pits = []
+
+    async def search(self, index=None, **kwargs):
+        self.searches.append(copy.deepcopy(dict(kwargs, index=index)))
+        hits = {"hits": self.pages.pop(0) if self.pages else []}
+        if self.total is not False:
+            hits["total"] = self.total
+        result = {"hits": hits}
+        if "pit" in kwargs.get("body", {}):
+            result["pit_id"] = kwargs["body"]["pit"]["id"]
+        return result
+
+    async def open_point_in_time(self, index, keep_alive, **kwargs):
+        self.open_pits.append((index, keep_alive))
+        return {"id": f"pit{len(self.open_pits)}"}
+
+    async def close_point_in_time(self, id):
+        self.closed_pits.append(id)
+
+    async def count(self, index, body):
+        self.counts.append(body)
+        return {"count": self.count_result}
+
+
+def patch_search_raw(monkeypatch, utility, conn, container):
+    """
+    Run search_raw without elasticsearch nor a request. The security filter
+    is built from `container.roles`
+    """
+
+    async def get_container_index_name(container):
+        return "index"
+
+    async def build_security_query(context, query, size, scroll, unrestricted):
+        body = dict(query)
+        body["roles"] = getattr(context, "roles", None)
+        return {"body": body, "size": size}
+
+    async def noop(*args):
+        pass
+
+    monkeypatch.setattr(utility, "get_connection", lambda purpose=None: conn)
+    monkeypatch.setattr(utility, "get_container_index_name", get_container_index_name)
+    monkeypatch.setattr(utility, "_build_security_query", build_security_query)
+    monkeypatch.setattr(utility, "_get_items_from_result", lambda *args: [])
+    monkeypatch.setattr(
+        "guillotina_elasticsearch.utility.find_container", lambda context: container
+    )
+    monkeypatch.setattr(
+        "guillotina_elasticsearch.utility.get_object_url", lambda *args: "http://a"
+    )
+    monkeypatch.setattr("guillotina_elasticsearch.utility.notify", noop)
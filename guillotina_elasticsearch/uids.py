@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+
+
+class UidStore:
+    """
+    Sqlite file keeping the uid sets of a migration on disk, so they do not
+    need to fit in memory. Every set is a table of the database, the
+    checkpoint of the migration is kept with them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        # resumed migrations depend on this file, it has to survive a crash
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint "
+            "(id INTEGER PRIMARY KEY CHECK (id = 1), data TEXT NOT NULL)"
+        )
+        self._sets = {}
+
+    def get_checkpoint(self):
+        row = self.conn.execute("SELECT data FROM checkpoint WHERE id = 1").fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set_checkpoint(self, data):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO checkpoint (id, data) VALUES (1, ?)",
+            (json.dumps(data),),
+        )
+
+    def clear_checkpoint(self):
+        self.conn.execute("DELETE FROM checkpoint")
+
+    def get_set(self, name, clear=True):
+        """
+        Get the `name` uid set, emptied unless `clear` is false
+        """
+        if name not in self._sets:
+            self._sets[name] = DiskUidSet(self, name, clear=clear)
+        return self._sets[name]
+
+    def close(self, remove=False):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self._sets = {}
+        if remove:
+            for path in (self.path, self.path + "-wal", self.path + "-shm"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class DiskUidSet:
+    """
+    Set of uids stored in a table of a `UidStore`. It supports what the
+    migrator uses from sets and lists: add/append, update, discard, `in`,
+    `len` and iteration, which is done in pages of `page_size` uids.
+    """
+
+    page_size = 1000
+
+    def __init__(self, store, name, clear=True):
+        self.store = store
+        self.name = name
+        conn = store.conn
+        if clear:
+            conn.execute(f"DROP TABLE IF EXISTS {name}")
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} "
+            "(id INTEGER PRIMARY KEY, uid TEXT NOT NULL UNIQUE)"
+        )
+        # counting rows goes through the whole table, keep track of it
+        self._len = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+
+    @property
+    def conn(self):
+        return self.store.conn
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, uid):
+        return (
+            self.conn.execute(
+                f"SELECT 1 FROM {self.name} WHERE uid = ?", (uid,)
+            ).fetchone()
+            is not None
+        )
+
+    def __iter__(self):
+        last = 0
+        while True:
+            rows = self.conn.execute(
+                f"SELECT id, uid FROM {self.name} WHERE id > ? ORDER BY id LIMIT ?",
+                (last, self.page_size),
+            ).fetchall()
+            if len(rows) == 0:
+                break
+            for _, uid in rows:
+                yield uid
+            last = rows[-1][0]
+
+    def add(self, uid):
+        cursor = self.conn.execute(
+            f"INSERT OR IGNORE INTO {self.name} (uid) VALUES (?)", (uid,)
+        )
+        self._len += cursor.rowcount
+
+    append = add
+
+    def update(self, uids):
+        self.conn.execute("BEGIN")
+        try:
+            cursor = self.conn.executemany(
+                f"INSERT OR IGNORE INTO {self.name} (uid) VALUES (?)",
+                ((uid,) for uid in uids),
+            )
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        self._len += cursor.rowcount
+
+    def discard(self, uid):
+        cursor = self.conn.execute(f"DELETE FROM {self.name} WHERE uid = ?", (uid,))
+        self._len -= cursor.rowcount
@@ -20,20 +20,34 @@ from guillotina.utils import merge_dicts
 from guillotina.utils import navigate_to
 from guillotina.utils import resolve_dotted_name
 from guillotina.utils.misc import get_current_container
+from guillotina_elasticsearch.bulk import bulk_serializer
+from guillotina_elasticsearch.bulk import BulkWriter
+from guillotina_elasticsearch.bulk import get_bulk_body
+from guillotina_elasticsearch.bulk import get_bulk_operations
+from guillotina_elasticsearch.bulk import update_to_index_operation
+from guillotina_elasticsearch.cache import SearchResultCache
 from guillotina_elasticsearch.connection import AsyncElasticsearch
 from guillotina_elasticsearch.connection import get_connection_settings
 from guillotina_elasticsearch.events import SearchDoneEvent
 from guillotina_elasticsearch.exceptions import ElasticsearchConflictException
 from guillotina_elasticsearch.exceptions import QueryErrorException
+from guillotina_elasticsearch.indexing import IndexingQueue
 from guillotina_elasticsearch.interfaces import IConnectionFactoryUtility
 from guillotina_elasticsearch.interfaces import IElasticSearchUtility  # noqa b/w compat
 from guillotina_elasticsearch.interfaces import IIndexManager
+from guillotina_elasticsearch.parser import invalidate_parse_cache
 from guillotina_elasticsearch.parser import Parser
-from guillotina_elasticsearch.utils import format_hit
+from guillotina_elasticsearch.utils import encode_cursor
+from guillotina_elasticsearch.utils import get_cached_indexes
+from guillotina_elasticsearch.utils import get_hit_formatter
 from guillotina_elasticsearch.utils import get_migration_lock
 from guillotina_elasticsearch.utils import get_parent_by_interface
+from guillotina_elasticsearch.utils import get_top_paths
+from guillotina_elasticsearch.utils import invalidate_index_name_cache
+from guillotina_elasticsearch.utils import multi_valued_fields
 from guillotina_elasticsearch.utils import noop_response
 from guillotina_elasticsearch.utils import safe_es_call
+from guillotina_elasticsearch.utils import set_cached_indexes
 
 import asyncio
 import backoff
@@ -46,18 +60,37 @@ import time
 logger = logging.getLogger("guillotina_elasticsearch")
 
 MAX_RETRIES_ON_REINDEX = 5
+BULK_RETRY_INTERVAL = 0.5
+DEFERRED_WRITE_ATTEMPTS = 3
 
 
 @configure.utility(provides=IConnectionFactoryUtility)
 class DefaultConnnectionFactoryUtility:
     """
-    Default uses single connection for entire application
+    Default uses single connection for entire application.
+
+    When `search_connection_settings` or `bulk_connection_settings` are
+    configured, searches or bulk writes use their own connection, with those
+    settings merged over `connection_settings`
     """
 
     def __init__(self):
         self._conn = None
-
-    def get(self, loop=None):
+        self._purpose_conns = {}
+
+    def get(self, loop=None, purpose=None):
+        if purpose is not None:
+            settings = app_settings.get("elasticsearch", {})
+            overrides = settings.get(f"{purpose}_connection_settings")
+            if overrides:
+                if purpose not in self._purpose_conns:
+                    connection_settings = get_connection_settings(
+                        settings.get("connection_settings"), overrides
+                    )
+                    self._purpose_conns[purpose] = AsyncElasticsearch(
+                        **connection_settings,
+                    )
+                return self._purpose_conns[purpose]
         if self._conn is None:
             connection_settings = get_connection_settings(
                 app_settings.get("elasticsearch", {}).get("connection_settings")
@@ -68,14 +101,18 @@ class DefaultConnnectionFactoryUtility:
         return self._conn
 
     async def close(self, loop=None):
+        conns = list(self._purpose_conns.values())
+        self._purpose_conns = {}
         if self._conn is not None:
+            conns.append(self._conn)
+            self._conn = None
+        for conn in conns:
             current_loop = asyncio.get_running_loop()
             if loop is not None and loop.is_running() and loop != current_loop:
-                future = asyncio.run_coroutine_threadsafe(self._conn.close(), loop)
+                future = asyncio.run_coroutine_threadsafe(conn.close(), loop)
                 await asyncio.wrap_future(future)
             else:
-                await self._conn.close()
-            self._conn = None
+                await conn.close()
 
 
 class ElasticSearchUtility(DefaultSearchUtility):
@@ -84,11 +121,59 @@ class ElasticSearchUtility(DefaultSearchUtility):
     def __init__(self, settings={}, loop=None):
         self.loop = loop
         self._conn_util = None
+        self._deferred_write = None
+        self._deferred_pending = 0
+        # documents that could not be written to the next index
+        self.deferred_write_failures = 0
+        self.indexing_queue = None
+        self.update_queue = None
+        self._delete_tasks = []
+        self.search_cache = None
 
     @property
     def bulk_size(self):
         return self.settings.get("bulk_size", 50)
 
+    @property
+    def bulk_max_bytes(self):
+        return self.settings.get("bulk_max_bytes")
+
+    @property
+    def bulk_concurrency(self):
+        return self.settings.get("bulk_concurrency", 4)
+
+    @property
+    def index_name_cache_ttl(self):
+        return self.settings.get("index_name_cache_ttl", 5)
+
+    @property
+    def defer_migration_writes(self):
+        return self.settings.get("defer_migration_writes", False)
+
+    @property
+    def deferred_writes_max_pending(self):
+        return self.settings.get("deferred_writes_max_pending", 8)
+
+    @property
+    def indexing_queue_settings(self):
+        return self.settings.get("indexing_queue") or {}
+
+    @property
+    def delete_children_chunk_size(self):
+        return self.settings.get("delete_children_chunk_size", 100)
+
+    @property
+    def delete_children_wait_for_completion(self):
+        return self.settings.get("delete_children_wait_for_completion", True)
+
+    @property
+    def search_cache_settings(self):
+        return self.settings.get("search_cache") or {}
+
+    @property
+    def update_coalesce_window(self):
+        return self.settings.get("update_coalesce_window", 0)
+
     def _refresh(self):
         if not hasattr(self, "__refresh"):
             val = self.settings.get("refresh")
@@ -109,9 +194,15 @@ class ElasticSearchUtility(DefaultSearchUtility):
         # b/w compat
         return self.get_connection()
 
-    def get_connection(self) -> AsyncElasticsearch:
+    def get_connection(self, purpose=None) -> AsyncElasticsearch:
+        """
+        `purpose` ("search" or "bulk") routes the request to its dedicated
+        connection when one is configured
+        """
         if self._conn_util is None:
             self._conn_util = get_utility(IConnectionFactoryUtility)
+        if purpose is not None and self.settings.get(f"{purpose}_connection_settings"):
+            return self._conn_util.get(loop=self.loop, purpose=purpose)
         return self._conn_util.get(loop=self.loop)
 
     @property
@@ -121,8 +212,40 @@ class ElasticSearchUtility(DefaultSearchUtility):
     async def initialize(self, app):
         self.app = app
         await self.check_supported_version()
+        multi_valued_fields.build()
+        invalidate_parse_cache()
+        cache_settings = self.search_cache_settings
+        if cache_settings.get("enabled"):
+            self.search_cache = SearchResultCache(
+                size=cache_settings.get("size", 1000),
+                ttl=cache_settings.get("ttl", 5),
+            )
+        queue_settings = self.indexing_queue_settings
+        if self.enabled and queue_settings.get("enabled"):
+            self.indexing_queue = IndexingQueue(
+                self,
+                max_size=queue_settings.get("max_size", 10000),
+                wait=queue_settings.get("wait", 0.1),
+                max_attempts=queue_settings.get("max_attempts", 3),
+            )
+            self.indexing_queue.start()
+        elif self.enabled and self.update_coalesce_window:
+            # only partial updates are delayed, other writes flush them first
+            self.update_queue = IndexingQueue(
+                self,
+                max_size=queue_settings.get("max_size", 10000),
+                wait=self.update_coalesce_window,
+            )
+            self.update_queue.start()
 
     async def finalize(self, app):
+        if self.indexing_queue is not None:
+            await self.indexing_queue.close()
+            self.indexing_queue = None
+        if self.update_queue is not None:
+            await self.update_queue.close()
+            self.update_queue = None
+        await self.join_deferred_writes()
         if self._conn_util is not None:
             await self._conn_util.close()
 
@@ -193,6 +316,8 @@ class ElasticSearchUtility(DefaultSearchUtility):
             await safe_es_call(conn.indices.delete, index=migration_index)
 
     async def remove_catalog(self, container):
+        invalidate_index_name_cache(container)
+        self.invalidate_search_cache(container)
         if not self.enabled:
             return
         index_manager = get_adapter(container, IIndexManager)
@@ -239,22 +364,27 @@ class ElasticSearchUtility(DefaultSearchUtility):
         logger.debug(result)
         return result
 
-    def _get_items_from_result(self, container, request, result):
+    def _get_items_from_result(self, container, request, result, fields=None):
+        """
+        `fields` are the stored fields requested by the query, used to
+        prepare the hit formatter
+        """
         items = []
         container_url = get_object_url(container, request)
+        formatter = get_hit_formatter(fields)
         for item in result["hits"]["hits"]:
-            data = format_hit(item)
-            data.update(
-                {
-                    "@id": container_url + data.get("path", ""),
-                    "@type": data.get("type_name"),
-                    "@uid": item["_id"],
-                    "@name": data.get("id", data.get("path", "").split("/")[-1]),
-                }
-            )
+            data = formatter(item)
+            path = data.get("path", "")
+            data["@id"] = container_url + path
+            data["@type"] = data.get("type_name")
+            data["@uid"] = item["_id"]
+            if "id" in data:
+                data["@name"] = data["id"]
+            else:
+                data["@name"] = path.split("/")[-1]
             sort_value = item.get("sort")
             if sort_value:
-                data.update({"sort": sort_value})
+                data["sort"] = sort_value
             if "highlight" in item:
                 data["@highlight"] = item["highlight"]
             items.append(data)
@@ -270,9 +400,14 @@ class ElasticSearchUtility(DefaultSearchUtility):
         scroll=None,
         index=None,
         unrestricted=False,
+        count_total=False,
     ):
         """
         Search raw query
+
+        `items_total_relation` is "gte" when `items_total` is a lower bound,
+        see `track_total_hits`. With `count_total` a count request is done
+        to get the exact total in that case.
         """
         container = find_container(context)
         if container is None:
@@ -288,27 +423,70 @@ class ElasticSearchUtility(DefaultSearchUtility):
 
         q = await self._build_security_query(context, query, size, scroll, unrestricted)
         q["ignore_unavailable"] = True
+        track_total_hits = self.settings.get("track_total_hits")
+        if track_total_hits is not None and "track_total_hits" not in q["body"]:
+            q["body"]["track_total_hits"] = track_total_hits
 
         logger.debug("Generated query %s", json.dumps(query))
-        conn = self.get_connection()
+        conn = self.get_connection("search")
         if "size" in q["body"] and "size" in q:
             # ValueError: Received multiple values for 'size', specify parameters using either body or parameters, not both.
             del q["size"]
-        result: ObjectApiResponse = await conn.search(index=index, **q)
+        cache_key = None
+        pit = q["body"].get("pit")
+        if self.search_cache is not None and not scroll and pit is None:
+            # the security filter is part of the query body
+            cache_key = self.search_cache.get_key(
+                container,
+                index,
+                get_object_url(container, request),
+                json.dumps(q, sort_keys=True, default=str),
+            )
+            final = self.search_cache.get(cache_key)
+            if final is not None:
+                tdif = time.time() - t1
+                await notify(
+                    SearchDoneEvent(query, final["items_total"], request, tdif)
+                )
+                return final
+        search_index = index
+        if pit is not None:
+            pit = q["body"]["pit"] = dict(pit)
+            if not pit.get("id"):
+                opened = await conn.open_point_in_time(
+                    index=index,
+                    keep_alive=pit.get("keep_alive") or "1m",
+                    ignore_unavailable=True,
+                )
+                pit["id"] = opened["id"]
+            # the point in time defines the index to search on
+            search_index = None
+            del q["ignore_unavailable"]
+        result: ObjectApiResponse = await conn.search(index=search_index, **q)
         if result.get("_shards", {}).get("failed", 0) > 0:
             logger.warning(f'Error running query: {result["_shards"]}')
             error_message = "Unknown"
             for failure in result["_shards"].get("failures") or []:
                 error_message = failure["reason"]
             raise QueryErrorException(reason=error_message)
-        items = self._get_items_from_result(container, request, result)
-        items_total = result["hits"]["total"]["value"]
-        # Seems like items_total will be max 10k always no matter what
-        # the max_result_window_value is
-        if items_total == 10000:
+        items = self._get_items_from_result(
+            container, request, result, q["body"].get("stored_fields")
+        )
+        total = result["hits"].get("total")
+        if total is None:
+            # track_total_hits disabled
+            total = {"value": len(items), "relation": "gte"}
+        items_total = total["value"]
+        relation = total.get("relation", "eq")
+        if count_total and relation != "eq":
             count = await conn.count(index=index, body={"query": q["body"]["query"]})
             items_total = count["count"]
-        final = {"items_total": items_total, "items": items}
+            relation = "eq"
+        final = {
+            "items_total": items_total,
+            "items_total_relation": relation,
+            "items": items,
+        }
 
         if "aggregations" in result:
             final["aggregations"] = result["aggregations"]
@@ -318,12 +496,101 @@ class ElasticSearchUtility(DefaultSearchUtility):
             final["profile"] = result["profile"]
         if "_scroll_id" in result:
             final["_scroll_id"] = result["_scroll_id"]
+        elif not scroll:
+            await self._set_cursor(conn, q, pit, result, final)
+
+        if cache_key is not None:
+            self.search_cache.set(cache_key, final)
 
         tdif = time.time() - t1
         logger.debug(f"Time ELASTIC {tdif}")
         await notify(SearchDoneEvent(query, items_total, request, tdif))
         return final
 
+    async def _set_cursor(self, conn, q, pit, result, final):
+        """
+        Add the cursor to get the next page with search_after. The point in
+        time is closed on the last page
+        """
+        hits = result["hits"]["hits"]
+        page_size = q["body"].get("size", q.get("size"))
+        pit_id = result.get("pit_id") or (pit and pit.get("id"))
+        cursor = None
+        if len(hits) > 0 and "sort" in hits[-1] and len(hits) >= (page_size or 0):
+            try:
+                cursor = encode_cursor(
+                    hits[-1]["sort"], pit_id, pit and pit.get("keep_alive")
+                )
+            except ValueError:
+                logger.warning(
+                    "No cursor for point in time searches without jwt.secret"
+                )
+        if cursor is not None:
+            final["cursor"] = cursor
+        elif pit_id is not None:
+            await safe_es_call(conn.close_point_in_time, id=pit_id)
+
+    async def iter_search(
+        self,
+        context,
+        query,
+        page_size=1000,
+        keep_alive="1m",
+        request=None,
+        unrestricted=False,
+    ):
+        """
+        Iterate over all the results of the query with a point in time and
+        search_after, keeping only a page of `page_size` results in memory.
+
+        The point in time is closed once the iteration finishes. When it can
+        be stopped early use `contextlib.aclosing` so it is closed right away.
+        """
+        container = find_container(context)
+        if container is None:
+            raise ContainerNotFound()
+        index = await self.get_container_index_name(container)
+        if request is None:
+            try:
+                request = get_current_request()
+            except RequestNotFound:
+                pass
+
+        q = await self._build_security_query(
+            context, query, page_size, None, unrestricted
+        )
+        body = q["body"]
+        body["size"] = page_size
+        body.pop("from", None)
+        body.pop("search_after", None)
+        body.setdefault("track_total_hits", False)
+        if not body.get("sort"):
+            # cheapest sort to paginate a point in time
+            body["sort"] = [{"_shard_doc": "asc"}]
+
+        conn = self.get_connection("search")
+        result = await conn.open_point_in_time(
+            index=index, keep_alive=keep_alive, ignore_unavailable=True
+        )
+        pit_id = result["id"]
+        try:
+            while True:
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                result = await conn.search(body=body)
+                pit_id = result.get("pit_id") or pit_id
+                hits = result["hits"]["hits"]
+                if len(hits) == 0:
+                    break
+                body["search_after"] = hits[-1]["sort"]
+                for item in self._get_items_from_result(
+                    container, request, result, body.get("stored_fields")
+                ):
+                    yield item
+                if len(hits) < page_size:
+                    break
+        finally:
+            await safe_es_call(conn.close_point_in_time, id=pit_id)
+
     async def get_object_by_uuid(self, container, uuid):
         query = {"filter": {"term": {"uuid": uuid}}}
         result = await self.search_raw(container, query, container)
@@ -351,14 +618,37 @@ class ElasticSearchUtility(DefaultSearchUtility):
             )
         return path_query
 
+    async def get_children_query(self, paths):
+        """
+        Query matching the children of any of the paths
+        """
+        should = []
+        for path in paths:
+            path_query = await self.get_path_query(path)
+            should.append(path_query["query"])
+        return {"query": {"bool": {"should": should, "minimum_should_match": 1}}}
+
     async def unindex_all_children(
         self, container, resource, index_name=None, response=noop_response
     ):
-        content_path = get_content_path(resource)
-        response.write(b"Removing all children of %s" % content_path.encode("utf-8"))
-        # use future here because this can potentially take some
-        # time to clean up indexes, etc
-        await self.call_unindex_all_children(container, index_name, content_path)
+        await self.unindex_children(container, [resource], index_name, response)
+
+    async def unindex_children(
+        self, container, resources, index_name=None, response=noop_response
+    ):
+        """
+        Remove the children of all the resources. Paths are grouped in
+        delete_by_query requests of up to `delete_children_chunk_size` paths
+        """
+        paths = get_top_paths([get_content_path(resource) for resource in resources])
+        chunk_size = max(1, self.delete_children_chunk_size)
+        for idx in range(0, len(paths), chunk_size):
+            chunk = paths[idx : idx + chunk_size]
+            for content_path in chunk:
+                response.write(
+                    b"Removing all children of %s" % content_path.encode("utf-8")
+                )
+            await self.call_unindex_children(container, index_name, chunk)
 
     @backoff.on_exception(
         backoff.constant,
@@ -370,11 +660,39 @@ class ElasticSearchUtility(DefaultSearchUtility):
         path_query = await self.get_path_query(content_path)
         await self._delete_by_query(path_query, index_name)
 
+    @backoff.on_exception(
+        backoff.constant,
+        (asyncio.TimeoutError, elasticsearch.exceptions.ConnectionTimeout),
+        interval=1,
+        max_tries=5,
+    )
+    async def call_unindex_children(self, container, index_name, paths):
+        if len(paths) == 1:
+            path_query = await self.get_path_query(paths[0])
+        else:
+            path_query = await self.get_children_query(paths)
+        await self._delete_by_query(
+            path_query,
+            index_name,
+            wait_for_completion=self.delete_children_wait_for_completion,
+        )
+
     @backoff.on_exception(
         backoff.constant, (ElasticsearchConflictException,), interval=0.5, max_tries=5
     )
-    async def _delete_by_query(self, path_query, index_name):
+    async def _delete_by_query(self, path_query, index_name, wait_for_completion=True):
         conn = self.get_connection()
+        if not wait_for_completion:
+            result = await conn.delete_by_query(
+                index=index_name,
+                body=path_query,
+                ignore_unavailable="true",
+                conflicts="proceed",
+                wait_for_completion=False,
+            )
+            self._delete_tasks.append(result["task"])
+            logger.debug(f'Deleting children on task {result["task"]}')
+            return
         result = await conn.delete_by_query(
             index=index_name,
             body=path_query,
@@ -389,6 +707,40 @@ class ElasticSearchUtility(DefaultSearchUtility):
         else:
             self.log_result(result, "Deletion of children")
 
+    async def check_delete_tasks(self):
+        """
+        Check the children deletions running in the background, logging the
+        ones that finished with errors. Returns the ids of the running ones
+        """
+        conn = self.get_connection()
+        running = []
+        for task_id in self._delete_tasks:
+            try:
+                result = await conn.tasks.get(task_id=task_id)
+            except elasticsearch.exceptions.NotFoundError:
+                continue
+            except (
+                elasticsearch.exceptions.ApiError,
+                elasticsearch.exceptions.TransportError,
+            ):
+                running.append(task_id)
+                continue
+            if not result.get("completed"):
+                running.append(task_id)
+                continue
+            task_response = result.get("response") or {}
+            if (
+                result.get("error")
+                or task_response.get("failures")
+                or task_response.get("version_conflicts")
+            ):
+                logger.warning(
+                    f"Deletion of children task {task_id} finished with errors: "
+                    + json.dumps(getattr(result, "body", result))
+                )
+        self._delete_tasks = running
+        return running
+
     async def update_by_query(
         self, query, context=None, indexes=None
     ) -> ObjectApiResponse:
@@ -424,31 +776,120 @@ class ElasticSearchUtility(DefaultSearchUtility):
         interval=1,
         max_tries=5,
     )
-    async def bulk_insert(self, bulk_data, idents, count=0, response=noop_response):
-        conn = self.get_connection()
+    async def _send_bulk(self, bulk_data, idents, count=0, response=noop_response):
+        conn = self.get_connection("bulk")
         result = {}
         try:
-            response.write(b"Indexing %d" % (len(idents),))
             result = await conn.bulk(body=bulk_data, refresh=self._refresh())
-        except elasticsearch.exceptions.TransportError as e:
+        except (
+            elasticsearch.exceptions.TransportError,
+            elasticsearch.exceptions.ApiError,
+        ) as e:
+            if isinstance(e, elasticsearch.exceptions.ApiError) and (
+                e.status_code != 429
+            ):
+                raise
             count += 1
             if count > MAX_RETRIES_ON_REINDEX:
                 response.write(b"Could not index %s\n" % str(e).encode("utf-8"))
                 logger.error("Could not index " + " ".join(idents) + " " + str(e))
             else:
-                await asyncio.sleep(0.5)
-                result = await self.bulk_insert(bulk_data, idents, count)
+                await asyncio.sleep(BULK_RETRY_INTERVAL * 2 ** (count - 1))
+                result = await self._send_bulk(bulk_data, idents, count)
+        return getattr(result, "body", result)
 
-        if isinstance(result, dict) and result.get("errors"):
-            logger.error("Error indexing: {}".format(result))
+    async def bulk_insert(self, bulk_data, idents, count=0, response=noop_response):
+        """
+        Send bulk operations, as NDJSON, and retry only the items that were
+        rejected:
 
+        - 429 (queue full) and 409 (version conflict) are sent again with an
+          exponential backoff, updates are reapplied on the latest version
+        - 404 on update (document not indexed yet) is converted to an index
+
+        Returns the bulk result with the final item per operation, in the
+        original order, plus `failed` and `retried` information.
+        """
+        response.write(b"Indexing %d" % (len(idents),))
+        operations = get_bulk_operations(bulk_data)
+        items = [None] * len(operations)
+        result = {
+            "took": 0,
+            "errors": False,
+            "items": items,
+            "failed": [],
+            "retried": 0,
+        }
+        pending = list(range(len(operations)))
+        attempt = count
+        while pending:
+            body = get_bulk_body([operations[idx] for idx in pending])
+            resp = await self._send_bulk(body, idents, count=attempt, response=response)
+            if not resp:
+                # could not send the request at all
+                for idx in pending:
+                    operation = operations[idx]
+                    items[idx] = {
+                        operation.action: {
+                            "_index": operation.index,
+                            "_id": operation.id,
+                            "status": 503,
+                            "error": "Could not send bulk request",
+                        }
+                    }
+                break
+            result["took"] += resp.get("took", 0)
+            retry = []
+            for idx, item in zip(pending, resp.get("items", [])):
+                action_type, value = next(iter(item.items()))
+                status = value.get("status")
+                if "error" in value and attempt < MAX_RETRIES_ON_REINDEX:
+                    if status in (409, 429):
+                        retry.append(idx)
+                        continue
+                    if status == 404 and action_type == "update":
+                        operations[idx] = update_to_index_operation(operations[idx])
+                        retry.append(idx)
+                        continue
+                items[idx] = item
+            pending = retry
+            if pending:
+                attempt += 1
+                result["retried"] += len(pending)
+                await asyncio.sleep(BULK_RETRY_INTERVAL * 2 ** (attempt - 1))
+
+        for item in items:
+            if item is None:
+                continue
+            _, value = next(iter(item.items()))
+            if "error" in value:
+                result["failed"].append(
+                    {
+                        "_id": value.get("_id"),
+                        "_index": value.get("_index"),
+                        "status": value.get("status"),
+                        "error": value["error"],
+                    }
+                )
+        if result["failed"]:
+            result["errors"] = True
+            logger.error(f"Error indexing: {json.dumps(result['failed'])}")
         return result
 
     async def get_current_indexes(self, container):
         """
         Returns a list contining the alias (pointing to the current index) and
         if this method is called during a migration returns the next index name
+
+        The result is cached per container for `index_name_cache_ttl` seconds,
+        the index manager invalidates it when a migration starts or ends
         """
+        ttl = self.index_name_cache_ttl
+        if ttl:
+            indexes = get_cached_indexes(container)
+            if indexes is not None:
+                return indexes
+
         index_manager = get_adapter(container, IIndexManager)
 
         real_index_name = await index_manager.get_real_index_name()
@@ -463,8 +904,12 @@ class ElasticSearchUtility(DefaultSearchUtility):
         # but the doc update fails with a 404 error because the index is empty.
         alias = await index_manager.get_index_name()
         if next_index_name:
-            return [alias, next_index_name]
-        return [alias]
+            indexes = [alias, next_index_name]
+        else:
+            indexes = [alias]
+        if ttl:
+            set_cached_indexes(container, indexes, ttl)
+        return indexes
 
     async def index(
         self,
@@ -484,28 +929,17 @@ class ElasticSearchUtility(DefaultSearchUtility):
         else:
             indexes = [index_name]
 
-        tid = self._get_current_tid()
-
-        bulk_data = []
-        idents = []
-        result = {}
-        for ident, data in datas.items():
-            if tid and tid > (data.get("tid") or 0):
-                data["tid"] = tid
-            for index in indexes:
-                bulk_data.extend([{"index": {"_index": index, "_id": ident}}, data])
-            idents.append(ident)
-            if not flush_all and len(bulk_data) % (self.bulk_size * 2) == 0:
-                result = await self.bulk_insert(bulk_data, idents, response=response)
-                self.log_result(result)
-                idents = []
-                bulk_data = []
-
-        if len(bulk_data) > 0:
-            result = await self.bulk_insert(bulk_data, idents, response=response)
-            self.log_result(result)
-
-        return result
+        self._set_current_tid(datas)
+        if self.indexing_queue is not None and not flush_all:
+            await self.indexing_queue.put(indexes, "index", datas, container)
+            return
+        await self.join_coalesced_updates()
+        try:
+            return await self._write_documents(
+                indexes, datas, bulk_serializer.index, response, flush_all
+            )
+        finally:
+            self.invalidate_search_cache(container)
 
     def _get_current_tid(self):
         # make sure to get current committed tid or we may be one-behind
@@ -519,50 +953,143 @@ class ElasticSearchUtility(DefaultSearchUtility):
             pass
         return tid
 
+    def invalidate_search_cache(self, container=None):
+        if self.search_cache is not None:
+            self.search_cache.invalidate(container)
+
+    def invalidate_search_cache_key(self, container_key):
+        if self.search_cache is not None:
+            self.search_cache.invalidate_key(container_key)
+
+    async def join_coalesced_updates(self):
+        """
+        Send the updates waiting on the coalesce window
+        """
+        if self.update_queue is not None:
+            await self.update_queue.join()
+
+    def _set_current_tid(self, datas):
+        tid = self._get_current_tid()
+        if tid:
+            for data in datas.values():
+                if tid > (data.get("tid") or 0):
+                    data["tid"] = tid
+
     async def update(self, container, datas, response=noop_response, flush_all=False):
         """If there is request we get the container from there"""
         if not self.enabled:
             return
-        tid = self._get_current_tid()
 
         if len(datas) > 0:
-            bulk_data = []
-            idents = []
-            result = {}
             indexes = await self.get_current_indexes(container)
+            self._set_current_tid(datas)
+            if self.indexing_queue is not None and not flush_all:
+                await self.indexing_queue.put(indexes, "update", datas, container)
+                return
+            if self.update_queue is not None:
+                if not flush_all:
+                    await self.update_queue.put(indexes, "update", datas, container)
+                    return
+                await self.update_queue.join()
+            try:
+                return await self._write_documents(
+                    indexes, datas, bulk_serializer.update, response, flush_all
+                )
+            finally:
+                self.invalidate_search_cache(container)
+
+    async def _write_documents(
+        self, indexes, datas, build_operation, response=noop_response, flush_all=False
+    ):
+        """
+        Every document is serialized once and the encoded source is shared by
+        the operations of all the target indexes
+        """
+        defer = len(indexes) > 1 and self.defer_migration_writes
+        deferred = []
+        writer = BulkWriter(self, response=response, flush_all=flush_all)
+        for ident, data in datas.items():
+            encoded = bulk_serializer.encode(data)
+            operations = [
+                build_operation(index, ident, data, encoded=encoded)
+                for index in indexes
+            ]
+            if defer:
+                # only the alias is written inline, next index is done
+                # in the background
+                deferred.append((ident, operations[1:]))
+                operations = operations[:1]
+            await writer.add(ident, operations)
+
+        if deferred:
+            await self._defer_write(deferred)
+        return await writer.close()
+
+    async def _defer_write(self, documents):
+        """
+        Deferred writes are chained so they are applied in the same order they
+        were produced. Once `deferred_writes_max_pending` are pending, new
+        writes wait for them to be sent.
+        """
+        max_pending = self.deferred_writes_max_pending
+        if max_pending and self._deferred_pending >= max_pending:
+            await self.join_deferred_writes()
+        previous = self._deferred_write
 
-            for ident, data in datas.items():
-                if tid and tid > (data.get("tid") or 0):
-                    data["tid"] = tid
-                for index in indexes:
-                    bulk_data.extend(
-                        [
-                            {
-                                "update": {
-                                    "_index": index,
-                                    "_id": ident,
-                                    "retry_on_conflict": 3,
-                                }
-                            },
-                            {"doc": data},
-                        ]
-                    )
-                idents.append(ident)
-                if not flush_all and len(bulk_data) % (self.bulk_size * 2) == 0:
-                    result = await self.bulk_insert(
-                        bulk_data, idents, response=response
-                    )
-                    self.log_result(result)
-                    idents = []
-                    bulk_data = []
+        async def write():
+            try:
+                if previous is not None:
+                    await asyncio.wait([previous])
+                await self._send_deferred(documents)
+            finally:
+                self._deferred_pending -= 1
 
-            if len(bulk_data) > 0:
-                result = await self.bulk_insert(bulk_data, idents, response=response)
-                self.log_result(result)
-            return result
+        self._deferred_pending += 1
+        self._deferred_write = asyncio.ensure_future(write())
+
+    async def _send_deferred(self, documents):
+        """
+        Send deferred writes, the documents that could not be sent because
+        elasticsearch was unavailable are retried `DEFERRED_WRITE_ATTEMPTS`
+        times. Documents that still fail are logged and counted in
+        `deferred_write_failures`.
+        """
+        for attempt in range(DEFERRED_WRITE_ATTEMPTS):
+            if attempt > 0:
+                await asyncio.sleep(BULK_RETRY_INTERVAL * 2 ** (attempt - 1))
+            writer = BulkWriter(self)
+            try:
+                for ident, operations in documents:
+                    await writer.add(ident, operations)
+                result = await writer.close()
+            except Exception:
+                logger.warning("Error writing deferred migration data", exc_info=True)
+                continue
+            retry = {
+                failure["_id"]
+                for failure in result["failed"]
+                if (failure.get("status") or 500) >= 500
+            }
+            failed = len({failure["_id"] for failure in result["failed"]} - retry)
+            self.deferred_write_failures += failed
+            documents = [item for item in documents if item[0] in retry]
+            if len(documents) == 0:
+                return
+        self.deferred_write_failures += len(documents)
+        logger.error(
+            f"Could not write {len(documents)} deferred documents to the next "
+            f"index: {[ident for ident, _ in documents]}"
+        )
+
+    async def join_deferred_writes(self):
+        future = self._deferred_write
+        if future is not None:
+            await asyncio.wait([future])
+            if self._deferred_write is future:
+                self._deferred_write = None
 
     def log_result(self, result: ObjectApiResponse, label="ES Query"):
-        result = result.body
+        result = getattr(result, "body", result)
         if "errors" in result and result["errors"]:
             try:
                 if result["error"]["caused_by"]["type"] in (
@@ -588,16 +1115,38 @@ class ElasticSearchUtility(DefaultSearchUtility):
                 indexes = await self.get_current_indexes(container)
             else:
                 indexes = [index_name]
-            bulk_data = []
-            for obj in objects:
-                for index in indexes:
-                    bulk_data.append({"delete": {"_index": index, "_id": obj.__uuid__}})
-                if IFolder.providedBy(obj):
-                    await self.unindex_all_children(
-                        container, obj, index_name=",".join(indexes)
-                    )
-            conn = self.get_connection()
-            await conn.bulk(body=bulk_data, refresh=self._refresh())
+            idents = [obj.__uuid__ for obj in objects]
+            folders = [obj for obj in objects if IFolder.providedBy(obj)]
+            if self.indexing_queue is not None:
+                await self.indexing_queue.put(
+                    indexes, "delete", {ident: None for ident in idents}, container
+                )
+                if len(folders) > 0:
+                    # queued writes of the children must not land after
+                    # they are unindexed
+                    await self.indexing_queue.join()
+            else:
+                await self.join_coalesced_updates()
+                try:
+                    await self._delete_documents(indexes, idents)
+                finally:
+                    self.invalidate_search_cache(container)
+            if len(folders) > 0:
+                if len(self._delete_tasks) > 0:
+                    await self.check_delete_tasks()
+                await self.unindex_children(
+                    container, folders, index_name=",".join(indexes)
+                )
+                self.invalidate_search_cache(container)
+
+    async def _delete_documents(self, indexes, idents):
+        # pending writes to the next index must not land after the delete
+        await self.join_deferred_writes()
+        operations = []
+        for ident in idents:
+            for index in indexes:
+                operations.append(bulk_serializer.delete(index, ident))
+        return await self.bulk_insert(operations, idents)
 
     async def get_doc_count(self, container=None, index_name=None, query=None):
         if index_name is None:
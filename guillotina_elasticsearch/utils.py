@@ -1,15 +1,24 @@
 from elasticsearch import exceptions
+from guillotina import app_settings
+from guillotina import task_vars
 from guillotina.component import get_adapter
 from guillotina.component import get_utilities_for
 from guillotina.content import get_all_possible_schemas_for_type
 from guillotina.content import IResourceFactory
 from guillotina.schema.interfaces import ICollection
+from guillotina_elasticsearch.exceptions import InvalidCursorException
 from guillotina_elasticsearch.interfaces import IIndexManager
 from guillotina_elasticsearch.interfaces import SUB_INDEX_SEPERATOR
+from lru import LRU  # pylint: disable=E0611
 
 import asyncio
+import base64
 import guillotina.directives
+import hashlib
+import hmac
+import json
 import logging
+import time
 
 
 logger = logging.getLogger("guillotina_elasticsearch")
@@ -42,6 +51,103 @@ def get_migration_lock(name):
     return getattr(loop, key)
 
 
+_index_name_cache = {}
+
+
+def get_container_cache_key(container):
+    db = task_vars.db.get()
+    return (getattr(db, "id", None), container.__uuid__)
+
+
+def get_cached_indexes(container):
+    """
+    Return the cached list of indexes to write to for the container or None
+    """
+    key = get_container_cache_key(container)
+    try:
+        expires, indexes = _index_name_cache[key]
+    except KeyError:
+        return None
+    if expires < time.monotonic():
+        _index_name_cache.pop(key, None)
+        return None
+    return list(indexes)
+
+
+def set_cached_indexes(container, indexes, ttl):
+    key = get_container_cache_key(container)
+    _index_name_cache[key] = (time.monotonic() + ttl, tuple(indexes))
+
+
+def invalidate_index_name_cache(container=None):
+    if container is None:
+        _index_name_cache.clear()
+    else:
+        _index_name_cache.pop(get_container_cache_key(container), None)
+
+
+def get_top_paths(paths):
+    """
+    Remove the paths contained in other paths of the list
+    """
+    result = []
+    # sorted by segment, the paths inside another one always follow it
+    for path in sorted(set(paths), key=lambda path: path.split("/")):
+        if result and (result[-1] == "/" or path.startswith(result[-1] + "/")):
+            continue
+        result.append(path)
+    return result
+
+
+def _get_cursor_secret():
+    return (app_settings.get("jwt") or {}).get("secret") or ""
+
+
+def _sign_cursor(payload, secret):
+    return hmac.new(
+        secret.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256
+    ).hexdigest()[:32]
+
+
+def encode_cursor(search_after, pit_id=None, keep_alive=None):
+    """
+    Opaque pagination cursor with the sort values of the last hit and the
+    point in time to continue with. It is signed, so point in time ids of
+    other indexes can not be injected. Without a `jwt.secret` setting the
+    signature can be forged, cursors with a point in time raise ValueError
+    """
+    secret = _get_cursor_secret()
+    data = {"search_after": search_after}
+    if pit_id is not None:
+        if not secret:
+            raise ValueError("Point in time cursors need the jwt.secret setting")
+        data["pit"] = pit_id
+        data["keep_alive"] = keep_alive
+    payload = (
+        base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode())
+        .decode()
+        .rstrip("=")
+    )
+    return f"{payload}.{_sign_cursor(payload, secret)}"
+
+
+def decode_cursor(cursor):
+    try:
+        secret = _get_cursor_secret()
+        payload, signature = cursor.rsplit(".", 1)
+        if not hmac.compare_digest(signature, _sign_cursor(payload, secret)):
+            raise ValueError("Invalid signature")
+        padding = "=" * (-len(payload) % 4)
+        data = json.loads(base64.urlsafe_b64decode(payload + padding))
+        if not isinstance(data.get("search_after"), list):
+            raise ValueError("Invalid search_after")
+        if "pit" in data and not secret:
+            raise ValueError("Unsigned point in time")
+    except (AttributeError, TypeError, ValueError):
+        raise InvalidCursorException(content={"reason": "Invalid cursor"})
+    return data
+
+
 async def get_all_indexes_identifier(container=None, index_manager=None):
     if index_manager is None:
         index_manager = get_adapter(container, IIndexManager)
@@ -49,12 +155,27 @@ async def get_all_indexes_identifier(container=None, index_manager=None):
     return "{},{}{}*".format(index_name, index_name, SUB_INDEX_SEPERATOR)
 
 
-_stored_multi_valued = {}
+class MultiValuedFieldRegistry:
+    """
+    Index names of the fields of all the content types and behaviors with
+    whether they are multi valued.
+
+    It is built when the catalog utility is initialized, so the first search
+    does not pay for walking all the schemas. Call `invalidate` when types
+    or behaviors are registered later on.
+    """
+
+    def __init__(self):
+        self._fields = None
 
+    @property
+    def fields(self):
+        if self._fields is None:
+            self.build()
+        return self._fields
 
-def _is_multi_valued(check_field_name):
-    if len(_stored_multi_valued) == 0:
-        # load types and cache, once
+    def build(self):
+        fields = {}
         for name, _ in get_utilities_for(IResourceFactory):
             # For each type
             for schema in get_all_possible_schemas_for_type(name):
@@ -65,34 +186,104 @@ def _is_multi_valued(check_field_name):
                     index_name = catalog_info.get("index_name", field_name)
                     try:
                         field = schema[field_name]
-                        _stored_multi_valued[index_name] = ICollection.providedBy(
-                            field
-                        )  # noqa
+                        fields[index_name] = ICollection.providedBy(field)
                     except KeyError:
-                        _stored_multi_valued[index_name] = False
+                        fields[index_name] = False
+        self._fields = fields
+        # formatters have the multi valued flags compiled
+        invalidate_hit_formatters()
+        return fields
 
-    if check_field_name in _stored_multi_valued:
-        return _stored_multi_valued[check_field_name]
-    return False
+    def invalidate(self):
+        self._fields = None
+        invalidate_hit_formatters()
 
+    def is_multi_valued(self, name):
+        return self.fields.get(name, False)
 
-def format_hit(item):
-    data = item.pop("_source", {})
-    for key, val in item.get("fields", {}).items():
-        container_data = data
-        if isinstance(val, list):
-            if not _is_multi_valued(key):
+    def as_dict(self):
+        return dict(self.fields)
+
+
+multi_valued_fields = MultiValuedFieldRegistry()
+
+
+def _is_multi_valued(check_field_name):
+    return multi_valued_fields.is_multi_valued(check_field_name)
+
+
+class HitFormatter:
+    """
+    Formats hits to catalog data. How each field is handled (multi valued,
+    nested in an object) is resolved once per field name and reused for
+    every hit. Hits are not modified.
+    """
+
+    def __init__(self, fields=None):
+        self._fields = {}
+        for name in fields or []:
+            self._compile(name)
+
+    def _compile(self, name):
+        if "." in name:
+            parent, key = name.split(".", 1)
+        else:
+            parent, key = None, name
+        compiled = self._fields[name] = (parent, key, _is_multi_valued(name))
+        return compiled
+
+    def __call__(self, item):
+        data = item.get("_source")
+        data = {} if data is None else dict(data)
+        fields = item.get("fields")
+        if not fields:
+            return data
+        compiled_fields = self._fields
+        copied = None
+        for name, val in fields.items():
+            try:
+                parent, key, multi_valued = compiled_fields[name]
+            except KeyError:
+                parent, key, multi_valued = self._compile(name)
+            if not multi_valued and isinstance(val, list):
                 if len(val) == 1:
                     val = val[0]
                 elif len(val) == 0:
                     val = None
-        if "." in key:
-            name, key = key.split(".", 1)
-            if name not in container_data:
-                container_data[name] = {}
-            container_data = container_data[name]
-        container_data[key] = val
-    return data
+            if parent is None:
+                data[key] = val
+                continue
+            if copied is None:
+                copied = set()
+            if parent not in copied:
+                # do not modify the objects of the hit source
+                data[parent] = dict(data.get(parent) or {})
+                copied.add(parent)
+            data[parent][key] = val
+        return data
+
+
+_hit_formatters = LRU(128)
+
+
+def get_hit_formatter(fields=None):
+    """
+    Formatter for the hits of a query requesting the `fields` stored fields
+    """
+    key = tuple(fields or ())
+    try:
+        return _hit_formatters[key]
+    except KeyError:
+        formatter = _hit_formatters[key] = HitFormatter(fields)
+        return formatter
+
+
+def invalidate_hit_formatters():
+    _hit_formatters.clear()
+
+
+def format_hit(item):
+    return get_hit_formatter()(item)
 
 
 def get_parent_by_interface(content, interface):